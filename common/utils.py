@@ -1,3 +1,5 @@
+import json
+import time
 from datetime import datetime, timedelta, timezone
 from functools import reduce
 from typing import Annotated, Any
@@ -11,6 +13,12 @@ from common.constants import AuthSettings as Auth
 
 http_bearer = HTTPBearer()
 
+# seconds before expiration when cached token is regenerated
+JWT_REFRESH_MARGIN = 30
+
+# payload: (token, monotonic expiration time)
+_jwt_tokens: dict[str, tuple[str, float]] = {}
+
 
 def concat_url(url: httpx.URL | str, *endpoints: httpx.URL | str) -> str:
     def concat_two(url1: str, url2: httpx.URL | str) -> str:
@@ -30,6 +38,20 @@ def gen_jwt_token(payload: dict[str, Any]):
     return jwt.encode(to_encode, Auth.private_key, Auth.algorithm)
 
 
+def get_cached_jwt_token(payload: dict[str, Any]) -> str:
+    """Returns token for the same payload until it's about to expire,
+    so frequent requests don't sign new token every time"""
+    key = json.dumps(payload, sort_keys=True)
+    now = time.monotonic()
+    token, expire_at = _jwt_tokens.get(key, ("", 0.0))
+    if now < expire_at - JWT_REFRESH_MARGIN:
+        return token
+
+    token = gen_jwt_token(payload)
+    _jwt_tokens[key] = (token, now + Auth.expire_seconds)
+    return token
+
+
 async def check_jwt_token_dep(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(http_bearer)],
 ):
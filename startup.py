@@ -46,17 +46,41 @@ def webapp(host: str = "localhost", port: int = 8000, test_config: bool = False)
 
 
 @typer.command()
-def workers(count: int = 4, test_config: bool = False):
+def workers(count: int = 4, test_config: bool = False, prefetch: int = 40):
     from webapp.workers.reports.worker import worker
 
-    worker(count, test_config)
+    worker(count, test_config, prefetch)
 
 
 @typer.command()
-def scheduler(test_config: bool = False):
+def scheduler(test_config: bool = False, rebuild_alarms: bool = False):
     from webapp.workers.scheduler.worker import worker
 
-    worker(test_config)
+    worker(test_config, rebuild_alarms)
+
+
+@typer.command()
+def bench_scheduler(
+    jobs: int = 10_000,
+    days: float = 1,
+    alarms: int = 10_000,
+    memory_store: bool = False,
+    seed: int = 0,
+):
+    """Simulates scheduler work with virtual clock, needs fakeredis"""
+    import asyncio
+
+    from webapp.workers.scheduler.bench import (
+        bench_alarms,
+        bench_scheduler,
+        format_report,
+    )
+
+    logging.getLogger("Scheduler").setLevel(logging.WARNING)
+    report = asyncio.run(bench_scheduler(jobs, days, memory_store, seed))
+    print(format_report(f"Scheduler, {jobs} jobs, {days} days", report))
+    report = asyncio.run(bench_alarms(alarms, seed))
+    print(format_report(f"Alarms, {alarms} users", report))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+from datetime import datetime, timezone
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from fakeredis import FakeAsyncRedis
+
+from common.constants import Channel
+from webapp.core.redis import AlarmActions, AlarmIndexEntry, AlarmTaskInfo
+from webapp.core.redis import RedisKeys as rk
+from webapp.workers.scheduler.alarms import (
+    AlarmChange,
+    apply_alarm_tasks,
+    is_removed_entry,
+    rebucket_alarms,
+    update_alarms,
+)
+
+DATE = datetime(2024, 1, 15, 12, tzinfo=timezone.utc)
+
+
+def add_task(channel_id: int, alarm: str, tz: str | None = None) -> AlarmTaskInfo:
+    return AlarmTaskInfo(AlarmActions.add, Channel.telegram, channel_id, alarm, tz)
+
+
+def delete_task(channel_id: int, alarm: str) -> AlarmTaskInfo:
+    return AlarmTaskInfo(AlarmActions.delete, Channel.telegram, channel_id, alarm)
+
+
+class AlarmChangeTest(TestCase):
+    """Test cases for net effect of user's alarm tasks"""
+
+    def get_entry(
+        self, tasks: list[AlarmTaskInfo], old_entry: AlarmIndexEntry | None = None
+    ) -> AlarmIndexEntry | None:
+        change = AlarmChange()
+        for task in tasks:
+            change.apply(task)
+        return change.get_entry(old_entry, DATE)
+
+    def test_add(self):
+        entry = AlarmIndexEntry("10:00", "10:00", "Europe/London")
+        tasks = [add_task(1, "10:00", "Europe/London")]
+        self.assertEqual(self.get_entry(tasks), entry)
+        old_entry = AlarmIndexEntry("06:00", "09:00", None)
+        self.assertEqual(
+            self.get_entry([add_task(1, "13:00")], old_entry),
+            AlarmIndexEntry("10:00", "13:00", None),
+        )
+
+    def test_last_add_wins(self):
+        tasks = [add_task(1, "10:00"), add_task(1, "11:00"), add_task(1, "12:00")]
+        self.assertEqual(self.get_entry(tasks).alarm, "12:00")
+
+    def test_delete_added(self):
+        old_entry = AlarmIndexEntry("06:00", "09:00", None)
+        tasks = [add_task(1, "10:00"), delete_task(1, "10:00")]
+        self.assertIsNone(self.get_entry(tasks, old_entry))
+        # delete of another alarm doesn't cancel add
+        tasks = [add_task(1, "10:00"), delete_task(1, "11:00")]
+        self.assertEqual(self.get_entry(tasks, old_entry).alarm, "10:00")
+
+    def test_stale_delete(self):
+        old_entry = AlarmIndexEntry("06:00", "09:00", None)
+        tasks = [delete_task(1, "08:00")]
+        self.assertEqual(self.get_entry(tasks, old_entry), old_entry)
+        self.assertIsNone(self.get_entry([delete_task(1, "09:00")], old_entry))
+        self.assertIsNone(self.get_entry([delete_task(1, "09:00")]))
+
+
+class UpdateAlarmsTest(IsolatedAsyncioTestCase):
+    """Test cases for alarm index updates"""
+
+    async def asyncSetUp(self):
+        self.redis = FakeAsyncRedis(decode_responses=True)
+        self.index = rk.alarms_index(Channel.telegram)
+
+    async def asyncTearDown(self):
+        await self.redis.flushall()
+        await self.redis.aclose()
+
+    async def get_bucket(self, bucket: str) -> set[str]:
+        return await self.redis.smembers(rk.alarms_users(Channel.telegram, bucket))
+
+    async def test_move_between_buckets(self):
+        tasks = [("", add_task(1, "10:00")), ("", add_task(2, "10:00"))]
+        await apply_alarm_tasks(self.redis, tasks)
+        old_entry = AlarmIndexEntry.from_str(await self.redis.hget(self.index, "1"))
+        bucket = old_entry.bucket
+        self.assertEqual(await self.get_bucket(bucket), {"1", "2"})
+
+        await apply_alarm_tasks(self.redis, [("", add_task(1, "11:00"))])
+        entry = AlarmIndexEntry.from_str(await self.redis.hget(self.index, "1"))
+        self.assertEqual(await self.get_bucket(bucket), {"2"})
+        self.assertEqual(await self.get_bucket(entry.bucket), {"1"})
+
+        await apply_alarm_tasks(self.redis, [("", delete_task(1, "11:00"))])
+        self.assertIsNone(await self.redis.hget(self.index, "1"))
+        self.assertEqual(await self.get_bucket(entry.bucket), set())
+
+    async def test_conflict_is_retried(self):
+        await self.redis.hset(self.index, "1", "07:00;10:00;None")
+        await self.redis.sadd(rk.alarms_users(Channel.telegram, "07:00"), "1")
+        seen: list[AlarmIndexEntry | None] = []
+        hmget = self.redis.hmget
+
+        async def concurrent_hmget(*args, **kwargs):
+            infos = await hmget(*args, **kwargs)
+            # another consumer moves user between read and update
+            self.redis.hmget = hmget
+            await apply_alarm_tasks(self.redis, [("", add_task(1, "12:00"))])
+            return infos
+
+        def update(entry: AlarmIndexEntry | None) -> AlarmIndexEntry | None:
+            seen.append(entry)
+            return AlarmIndexEntry("08:00", "11:00", None)
+
+        self.redis.hmget = concurrent_hmget
+        self.assertEqual(
+            await update_alarms(self.redis, Channel.telegram, {"1": update}), 1
+        )
+        self.assertEqual(seen[1], AlarmIndexEntry("09:00", "12:00", None))
+        self.assertEqual(await self.get_bucket("07:00"), set())
+        self.assertEqual(await self.get_bucket("09:00"), set())
+        self.assertEqual(await self.get_bucket("08:00"), {"1"})
+
+    async def test_reclaimed_tasks(self):
+        await apply_alarm_tasks(self.redis, [("2-0", add_task(1, "12:00"))])
+        # older add reclaimed after newer one was applied
+        await apply_alarm_tasks(self.redis, [("1-0", add_task(1, "10:00"))])
+        entry = AlarmIndexEntry.from_str(await self.redis.hget(self.index, "1"))
+        self.assertEqual(entry, AlarmIndexEntry("09:00", "12:00", None, "2-0"))
+        self.assertEqual(await self.get_bucket("07:00"), set())
+
+        await apply_alarm_tasks(self.redis, [("3-0", delete_task(1, "12:00"))])
+        await apply_alarm_tasks(self.redis, [("2-5", add_task(1, "10:00"))])
+        entry = AlarmIndexEntry.from_str(await self.redis.hget(self.index, "1"))
+        self.assertTrue(is_removed_entry(entry))
+        self.assertEqual(await self.get_bucket("07:00"), set())
+        self.assertEqual(await self.get_bucket("09:00"), set())
+
+        # batch is applied in order of versions
+        tasks = [("5-0", delete_task(1, "11:00")), ("4-0", add_task(1, "11:00"))]
+        await apply_alarm_tasks(self.redis, tasks)
+        entry = AlarmIndexEntry.from_str(await self.redis.hget(self.index, "1"))
+        self.assertEqual(entry, AlarmIndexEntry("", "", None, "5-0"))
+
+    async def test_malformed_entry(self):
+        await self.redis.hset(
+            self.index, mapping={"1": "garbage", "2": "a;b;Nowhere/Zone"}
+        )
+        tasks = [("", add_task(channel_id, "10:00")) for channel_id in (1, 2, 3)]
+        self.assertEqual(await apply_alarm_tasks(self.redis, tasks), 3)
+        entries = await self.redis.hgetall(self.index)
+        alarms = {AlarmIndexEntry.from_str(entry).alarm for entry in entries.values()}
+        self.assertEqual(alarms, {"10:00"})
+
+    async def test_rebucket(self):
+        await self.redis.hset(
+            self.index,
+            mapping={
+                "1": "00:00;10:00;Europe/London",
+                "2": "00:00;10:00;None",
+                "3": ";;None;1-0",
+                "4": ";;None;3-0",
+            },
+        )
+        await self.redis.sadd(rk.alarms_users(Channel.telegram, "00:00"), "1", "2")
+        self.assertEqual(await rebucket_alarms(self.redis, Channel.telegram, "2-0"), 2)
+        self.assertEqual(await self.redis.hkeys(self.index), ["1", "2", "4"])
+        self.assertEqual(await self.get_bucket("00:00"), {"2"})
+        entry = AlarmIndexEntry.from_str(await self.redis.hget(self.index, "1"))
+        self.assertIn("1", await self.get_bucket(entry.bucket))
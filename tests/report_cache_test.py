@@ -0,0 +1,97 @@
+from unittest import IsolatedAsyncioTestCase
+
+from fakeredis import FakeAsyncRedis, FakeRedis, FakeServer
+
+from common.constants import Channel
+from webapp.api_v1.entries.jobs import bump_entries_version
+from webapp.core.models import User
+from webapp.core.redis import RedisKeys as rk
+from webapp.core.redis import ReportRequester, ReportTaskInfo
+from webapp.workers.reports.report_cache import (
+    cache_reports,
+    clear_reports_cache,
+    get_cached_reports,
+    get_report_digests,
+)
+
+TEMPLATE_VERSION = "template"
+REPORT_SIZE = 100
+
+
+def make_info(user_id: int) -> ReportTaskInfo:
+    return ReportTaskInfo(
+        user_id,
+        Channel.telegram,
+        user_id,
+        ReportRequester.channel,
+        "01.01.2024",
+        "07.01.2024",
+    )
+
+
+class ReportCacheTest(IsolatedAsyncioTestCase):
+    """Test cases for cache of rendered reports"""
+
+    async def asyncSetUp(self):
+        server = FakeServer()
+        # reports worker uses sync client, api uses async one
+        self.redis = FakeRedis(server=server, decode_responses=True)
+        self.async_redis = FakeAsyncRedis(server=server, decode_responses=True)
+
+    async def asyncTearDown(self):
+        await self.async_redis.flushall()
+        await self.async_redis.aclose()
+        self.redis.close()
+
+    def cache(self, user_ids: list[int], max_size: int) -> int:
+        digests = get_report_digests(
+            self.redis, [make_info(user_id) for user_id in user_ids], TEMPLATE_VERSION
+        )
+        reports = {
+            digest: str(user_id) * REPORT_SIZE
+            for digest, user_id in zip(digests, user_ids)
+        }
+        return cache_reports(self.redis, reports, max_size)
+
+    def get_cached(self, user_ids: list[int]) -> list[str | None]:
+        digests = get_report_digests(
+            self.redis, [make_info(user_id) for user_id in user_ids], TEMPLATE_VERSION
+        )
+        return get_cached_reports(self.redis, digests)
+
+    async def test_hit(self):
+        self.assertEqual(self.get_cached([1]), [None])
+        self.cache([1, 2], max_size=10 * REPORT_SIZE)
+        self.assertEqual(
+            self.get_cached([2, 1, 3]), ["2" * REPORT_SIZE, "1" * REPORT_SIZE, None]
+        )
+
+        # digest depends on template version
+        digests = get_report_digests(self.redis, [make_info(1)], "new template")
+        self.assertEqual(get_cached_reports(self.redis, digests), [None])
+
+    async def test_entries_version(self):
+        self.cache([1, 2], max_size=10 * REPORT_SIZE)
+        await bump_entries_version(self.async_redis, User(id=1))
+        self.assertEqual(self.get_cached([1, 2]), [None, "2" * REPORT_SIZE])
+
+    async def test_eviction(self):
+        max_size = 3 * REPORT_SIZE
+        self.assertEqual(self.cache([1, 2, 3], max_size), 0)
+        # touched report is recently used
+        self.get_cached([1])
+        self.assertEqual(self.cache([4], max_size), 1)
+        self.assertEqual(
+            self.get_cached([1, 2, 3, 4]),
+            ["1" * REPORT_SIZE, None, "3" * REPORT_SIZE, "4" * REPORT_SIZE],
+        )
+        self.assertEqual(int(self.redis.get(rk.reports_cache_size)), max_size)
+
+        # cached again report isn't counted twice
+        self.assertEqual(self.cache([4], max_size), 0)
+        self.assertEqual(int(self.redis.get(rk.reports_cache_size)), max_size)
+
+        await clear_reports_cache(self.async_redis)
+        self.assertEqual(self.get_cached([1]), [None])
+        self.assertEqual(self.cache([5], max_size), 0)
+        self.assertEqual(int(self.redis.get(rk.reports_cache_size)), REPORT_SIZE)
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta, timezone
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from fakeredis import FakeAsyncRedis
+
+from webapp.core.redis import RedisKeys as rk
+from webapp.workers.scheduler.rollout import (
+    delay_reports,
+    get_report_slot,
+    get_rollout_progress,
+    get_rollout_window,
+    release_reports,
+    start_rollout,
+)
+
+START = datetime(2024, 1, 1, 23, tzinfo=timezone.utc)
+MINUTE = timedelta(minutes=1)
+
+
+class RolloutWindowTest(TestCase):
+    """Test cases for reports rollout window and slots"""
+
+    def test_rollout_window(self):
+        self.assertEqual(get_rollout_window(1000, 0, 100), 0)
+        self.assertEqual(get_rollout_window(1000, 60, 0), 60)
+        self.assertEqual(get_rollout_window(1000, 60, 100), 60)
+        # window is extended to keep the rate
+        self.assertEqual(get_rollout_window(10_001, 60, 100), 101)
+
+    def test_report_slot(self):
+        # slot doesn't depend on process, unlike hash() of str
+        self.assertEqual(get_report_slot(1, 60), 23)
+        self.assertEqual(get_report_slot(42, 60), 8)
+        slots = {get_report_slot(user_id, 60) for user_id in range(1000)}
+        self.assertEqual(slots, set(range(60)))
+        self.assertEqual(get_report_slot(1, 0), 0)
+
+
+class RolloutTest(IsolatedAsyncioTestCase):
+    """Test cases for weekly reports spread over rollout window"""
+
+    async def asyncSetUp(self):
+        self.redis = FakeAsyncRedis(decode_responses=True)
+
+    async def asyncTearDown(self):
+        await self.redis.flushall()
+        await self.redis.aclose()
+
+    async def start(self, window: int, users: int) -> list[tuple[int, str]]:
+        tasks = [(user_id, f"report:{user_id}") for user_id in range(users)]
+        await start_rollout(self.redis, START, window, users)
+        await delay_reports(self.redis, START, window, tasks)
+        return tasks
+
+    async def get_ordered(self) -> list[str]:
+        entries = await self.redis.xrange(rk.reports_queue)
+        return [fields["task"] for _, fields in entries]
+
+    async def test_without_window(self):
+        tasks = await self.start(0, 10)
+        self.assertEqual(await self.get_ordered(), [task for _, task in tasks])
+        progress = await get_rollout_progress(self.redis)
+        self.assertEqual(progress["released"], 10)
+        self.assertEqual(progress["delayed"], 0)
+
+    async def test_window(self):
+        tasks = await self.start(10, 100)
+        self.assertEqual(await self.get_ordered(), [])
+        delayed = await self.redis.zrange(rk.reports_delayed, 0, -1, withscores=True)
+        scores = dict(delayed)
+        for user_id, task in tasks:
+            slot_time = START + MINUTE * get_report_slot(user_id, 10)
+            self.assertEqual(scores[task], slot_time.timestamp())
+
+        released = 0
+        for minute in range(10):
+            released += await release_reports(self.redis, START + MINUTE * minute, 0)
+            slots = [get_report_slot(user_id, 10) for user_id, _ in tasks]
+            self.assertEqual(released, sum(slot <= minute for slot in slots))
+
+        progress = await get_rollout_progress(self.redis)
+        self.assertEqual(progress["released"], 100)
+        self.assertEqual(progress["delayed"], 0)
+        self.assertEqual(len(await self.get_ordered()), 100)
+
+    async def test_rate(self):
+        # all reports have the same slot
+        await self.start(1, 250)
+        now = START + MINUTE / 2
+        self.assertEqual(await release_reports(self.redis, now, 100, batch=30), 100)
+        self.assertEqual(await release_reports(self.redis, now, 100, batch=30), 0)
+
+        # the rest of crowded slot is ordered in the next minutes
+        now += MINUTE
+        self.assertEqual(await release_reports(self.redis, now, 100), 100)
+        now += MINUTE
+        self.assertEqual(await release_reports(self.redis, now, 100), 50)
+
+        progress = await get_rollout_progress(self.redis)
+        self.assertEqual(progress["released"], 250)
+        self.assertEqual(progress["minute_released"], 50)
+        self.assertEqual(progress["delayed"], 0)
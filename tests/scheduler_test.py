@@ -0,0 +1,221 @@
+import asyncio
+from datetime import datetime, timedelta, timezone, tzinfo
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from fakeredis import FakeAsyncRedis, FakeServer
+
+from webapp.core.settings import RedisSettings, SchedulerSettings
+from webapp.workers.scheduler.job_stores import (
+    IJobStore,
+    MemoryJobStore,
+    RedisJobStore,
+    get_next_timestamp,
+)
+from webapp.workers.scheduler.jobs import Misfire, MisfirePolicy, scheduler_task
+from webapp.workers.scheduler.scheduler import Scheduler
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+MINUTE = timedelta(minutes=1)
+
+fire_times: list[datetime] = []
+
+
+@scheduler_task(pass_fire_time=True)
+async def scheduler_test_task(fire_time: datetime):
+    fire_times.append(fire_time)
+
+
+class FixedClock:
+    """Clock for Scheduler, which moves only when told to"""
+
+    def __init__(self, now: datetime) -> None:
+        self.now = now
+
+    def __call__(self, tz: tzinfo | None = None) -> datetime:
+        if tz is None:
+            return self.now.astimezone().replace(tzinfo=None)
+        return self.now.astimezone(tz)
+
+
+class MisfireTest(TestCase):
+    """Test cases for fire times run after misses"""
+
+    def test_coalesce(self):
+        misfire = Misfire(MisfirePolicy.coalesce)
+        date = START + MINUTE * 4.5
+        last_time = START + MINUTE * 4
+        self.assertEqual(misfire.get_run_times(START, MINUTE, date), [last_time])
+        self.assertEqual(misfire.get_run_times(START, None, date), [START])
+
+    def test_run_all(self):
+        misfire = Misfire(MisfirePolicy.run_all, max_runs=3)
+        date = START + MINUTE * 4.5
+        self.assertEqual(
+            misfire.get_run_times(START, MINUTE, date),
+            [START + MINUTE * 2, START + MINUTE * 3, START + MINUTE * 4],
+        )
+        self.assertEqual(
+            misfire.get_run_times(START, MINUTE, START + MINUTE * 1.5),
+            [START, START + MINUTE],
+        )
+
+    def test_skip(self):
+        misfire = Misfire(MisfirePolicy.skip, grace=timedelta(seconds=10))
+        late = START + MINUTE * 4 + timedelta(seconds=11)
+        self.assertEqual(misfire.get_run_times(START, MINUTE, late), [])
+        in_time = START + MINUTE * 4 + timedelta(seconds=10)
+        self.assertEqual(
+            misfire.get_run_times(START, MINUTE, in_time), [START + MINUTE * 4]
+        )
+
+
+class JobStoreTestMixin:
+    """Test cases shared by job stores"""
+
+    def make_store(self) -> IJobStore:
+        raise NotImplementedError
+
+    def setUp(self):
+        fire_times.clear()
+        self.clock = FixedClock(START)
+        self.store = self.make_store()
+        self.scheduler = Scheduler(
+            self.store, SchedulerSettings(task_limits={}), clock=self.clock
+        )
+        self.scheduler.set_timezone(timezone.utc)
+
+    async def add_job(self, job_id: str, interval: timedelta | None, **kwargs):
+        return await self.scheduler.add_job(
+            scheduler_test_task,
+            start_date=START + MINUTE,
+            interval=interval,
+            job_id=job_id,
+            **kwargs,
+        )
+
+    async def run_due_jobs(self, date: datetime) -> int:
+        self.clock.now = date
+        claimed = await self.scheduler.process_due_jobs()
+        while self.scheduler.metrics.pending or self.scheduler.metrics.running:
+            await asyncio.sleep(0)
+        return claimed
+
+    async def test_reschedule(self):
+        interval = timedelta(seconds=90)
+        await self.add_job("interval", interval)
+        fire_ts = (START + MINUTE).timestamp()
+        self.assertEqual(await self.store.get_next_run_time(), fire_ts)
+
+        for late in (0, 1, 89, 90, 91, 1000):
+            now = datetime.fromtimestamp(fire_ts + late, timezone.utc)
+            self.assertEqual(await self.run_due_jobs(now), 1)
+            next_ts = get_next_timestamp(
+                fire_ts, interval.total_seconds(), now.timestamp()
+            )
+            self.assertEqual(await self.store.get_next_run_time(), next_ts)
+            self.assertEqual(self.store.next_run_time, next_ts)
+            self.assertGreater(next_ts, now.timestamp())
+            fire_ts = next_ts
+
+        # nothing is due until the next fire time
+        now = datetime.fromtimestamp(fire_ts - 1, timezone.utc)
+        self.assertEqual(await self.run_due_jobs(now), 0)
+
+    async def test_one_time_job(self):
+        await self.add_job("once", None)
+        self.assertEqual(await self.run_due_jobs(START + MINUTE * 10), 1)
+        self.assertEqual(fire_times, [START + MINUTE])
+        self.assertIsNone(await self.store.get_job("once"))
+        self.assertIsNone(self.store.next_run_time)
+        self.assertEqual(await self.run_due_jobs(START + MINUTE * 20), 0)
+
+    async def test_coalesce(self):
+        misfire = Misfire(MisfirePolicy.coalesce)
+        await self.add_job("coalesce", MINUTE, misfire=misfire)
+        await self.run_due_jobs(START + MINUTE * 5.5)
+        self.assertEqual(fire_times, [START + MINUTE * 5])
+
+    async def test_run_all(self):
+        misfire = Misfire(MisfirePolicy.run_all, max_runs=3)
+        await self.add_job("run_all", MINUTE, misfire=misfire)
+        await self.run_due_jobs(START + MINUTE * 5.5)
+        self.assertEqual(
+            fire_times, [START + MINUTE * 3, START + MINUTE * 4, START + MINUTE * 5]
+        )
+
+    async def test_skip(self):
+        misfire = Misfire(MisfirePolicy.skip, grace=timedelta(seconds=10))
+        await self.add_job("skip", MINUTE, misfire=misfire)
+        await self.run_due_jobs(START + MINUTE * 5.5)
+        self.assertEqual(fire_times, [])
+        self.assertEqual(self.scheduler.metrics.skipped, 1)
+
+        await self.run_due_jobs(START + MINUTE * 6 + timedelta(seconds=5))
+        self.assertEqual(fire_times, [START + MINUTE * 6])
+
+    async def test_keep_existing(self):
+        await self.add_job("periodic", MINUTE)
+        await self.run_due_jobs(START + MINUTE * 1.5)
+        next_ts = (START + MINUTE * 2).timestamp()
+
+        # start date of periodic job changes on every scheduler start
+        stored_job = await self.store.get_job("periodic")
+        job = await self.scheduler.add_job(
+            scheduler_test_task,
+            start_date=START + MINUTE * 10,
+            interval=MINUTE,
+            job_id="periodic",
+            replace_existing=False,
+        )
+        self.assertIs(job, stored_job)
+        self.assertEqual(await self.store.get_next_run_time(), next_ts)
+
+        # changed definition replaces stored job, but keeps its schedule
+        misfire = Misfire(MisfirePolicy.run_all, max_runs=3)
+        job = await self.scheduler.add_job(
+            scheduler_test_task,
+            start_date=START + MINUTE * 10,
+            interval=MINUTE * 2,
+            job_id="periodic",
+            misfire=misfire,
+            replace_existing=False,
+        )
+        stored_job = await self.store.get_job("periodic")
+        self.assertEqual(stored_job.get_definition(), job.get_definition())
+        self.assertEqual(await self.store.get_next_run_time(), next_ts)
+
+        fire_times.clear()
+        await self.run_due_jobs(START + MINUTE * 6.5)
+        self.assertEqual(
+            fire_times, [START + MINUTE * 2, START + MINUTE * 4, START + MINUTE * 6]
+        )
+        next_ts = (START + MINUTE * 8).timestamp()
+        self.assertEqual(await self.store.get_next_run_time(), next_ts)
+
+
+class MemoryJobStoreTest(JobStoreTestMixin, IsolatedAsyncioTestCase):
+
+    def make_store(self) -> IJobStore:
+        return MemoryJobStore()
+
+
+class RedisJobStoreTest(JobStoreTestMixin, IsolatedAsyncioTestCase):
+
+    def make_store(self) -> IJobStore:
+        self.server = FakeServer()
+        client = FakeAsyncRedis(server=self.server)
+        return RedisJobStore(RedisSettings(), client=client)
+
+    async def test_double_claim(self):
+        await self.add_job("shared", MINUTE)
+        other_store = RedisJobStore(
+            RedisSettings(), client=FakeAsyncRedis(server=self.server)
+        )
+        now = START + MINUTE * 3.5
+        claims = await asyncio.gather(
+            self.store.claim_due_jobs(now, 10), other_store.claim_due_jobs(now, 10)
+        )
+        self.assertEqual(sorted(len(jobs) for jobs in claims), [0, 1])
+        next_ts = (START + MINUTE * 4).timestamp()
+        self.assertEqual(self.store.next_run_time, next_ts)
+        self.assertEqual(other_store.next_run_time, next_ts)
@@ -0,0 +1,95 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from fakeredis import FakeAsyncRedis
+
+from webapp.core.redis import TaskStream, enqueue_tasks
+from webapp.core.settings import QueuesSettings
+
+STREAM = "tasks:queue"
+DEAD_LETTERS = "tasks:dead-letters"
+GROUP = "tasks:group"
+LEGACY_QUEUE = "tasks:legacy"
+# seconds
+CLAIM_IDLE = 0.1
+
+
+class TaskStreamTest(IsolatedAsyncioTestCase):
+    """Test cases for tasks queue on redis stream"""
+
+    async def asyncSetUp(self):
+        self.redis = FakeAsyncRedis(decode_responses=True)
+        self.settings = QueuesSettings(
+            max_len=100, claim_idle=CLAIM_IDLE, claim_interval=0, max_deliveries=2
+        )
+        self.stream = await self.start_consumer("first")
+
+    async def asyncTearDown(self):
+        await self.redis.flushall()
+        await self.redis.aclose()
+
+    async def start_consumer(
+        self, consumer: str, legacy_queue: str | None = None
+    ) -> TaskStream:
+        stream = TaskStream(self.redis, STREAM, DEAD_LETTERS, GROUP, self.settings)
+        stream.consumer = consumer
+        await stream.start(legacy_queue)
+        return stream
+
+    async def enqueue(self, *tasks: str):
+        await enqueue_tasks(self.redis, STREAM, list(tasks), self.settings.max_len)
+
+    async def test_ack(self):
+        await self.enqueue("a", "b")
+        entries = await self.stream.read(10, block=0.01)
+        self.assertEqual([task for _, task in entries], ["a", "b"])
+        self.assertEqual(await self.stream.read(10, block=0.01), [])
+
+        await self.stream.ack([entries[0][0]])
+        self.assertEqual(await self.stream.get_backlog(), 1)
+        pending = await self.redis.xpending(STREAM, GROUP)
+        self.assertEqual(pending["pending"], 1)
+
+    async def test_reclaim(self):
+        await self.enqueue("a")
+        entries = await self.stream.read(10, block=0.01)
+
+        # pending task of consumer isn't taken over until claim_idle
+        other = await self.start_consumer("second")
+        self.assertEqual(await other.read(10, block=0.01), [])
+        await asyncio.sleep(CLAIM_IDLE * 1.5)
+        self.assertEqual(await other.read(10, block=0.01), entries)
+
+        await other.ack([entry_id for entry_id, _ in entries])
+        await asyncio.sleep(CLAIM_IDLE * 1.5)
+        self.assertEqual(await self.stream.read(10, block=0.01), [])
+
+    async def test_bury(self):
+        await self.enqueue("a", "b")
+        entries = await self.stream.read(10, block=0.01)
+        await self.stream.ack([entries[1][0]])
+        await asyncio.sleep(CLAIM_IDLE * 1.5)
+        self.assertEqual(await self.stream.read(10, block=0.01), entries[:1])
+
+        # task delivered max_deliveries times is moved to dead letters
+        await asyncio.sleep(CLAIM_IDLE * 1.5)
+        self.assertEqual(await self.stream.read(10, block=0.01), [])
+        self.assertEqual(await self.stream.get_backlog(), 0)
+        dead_letters = await self.redis.xrange(DEAD_LETTERS)
+        self.assertEqual(len(dead_letters), 1)
+        self.assertEqual(
+            dead_letters[0][1],
+            {"id": entries[0][0], "reason": "max deliveries", "task": "a"},
+        )
+
+        # task reclaimed by several consumers at once is buried once
+        self.assertEqual(await self.stream.bury([entries[0][0]], "again"), 0)
+
+    async def test_legacy_queue(self):
+        await self.enqueue("a")
+        await self.redis.rpush(LEGACY_QUEUE, "b", "c")
+        # group already exists
+        stream = await self.start_consumer("second", LEGACY_QUEUE)
+        self.assertFalse(await self.redis.exists(LEGACY_QUEUE))
+        entries = await stream.read(10, block=0.01)
+        self.assertEqual([task for _, task in entries], ["a", "b", "c"])
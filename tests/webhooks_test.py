@@ -0,0 +1,172 @@
+import json
+import time
+from unittest import IsolatedAsyncioTestCase
+
+import httpx
+from fakeredis import FakeAsyncRedis
+
+from common.constants import Channel
+from webapp.core.redis import RedisKeys as rk
+from webapp.core.settings import OutboxSettings
+from webapp.workers import webhooks
+from webapp.workers.webhooks import (
+    DeliveryOutcome,
+    Webhook,
+    async_enqueue_webhook,
+    async_send_webhook,
+    close_hooks_client,
+    dispatch_outbox,
+    get_retry_delay,
+)
+
+CHANNEL_URL = "https://channel.test/hooks"
+
+
+class WebhooksTest(IsolatedAsyncioTestCase):
+    """Test cases for webhooks outbox, retries and circuit breaker"""
+
+    async def asyncSetUp(self):
+        self.redis = FakeAsyncRedis(decode_responses=True)
+        await self.redis.set(rk.webhooks_url(Channel.telegram), CHANNEL_URL)
+        self.settings = OutboxSettings(
+            max_attempts=3, backoff_base=10, backoff_cap=40, circuit_threshold=2
+        )
+        self.status_code = 200
+        self.requests: list[httpx.Request] = []
+        webhooks._hooks_client = httpx.AsyncClient(
+            transport=httpx.MockTransport(self.handle_request)
+        )
+
+    async def asyncTearDown(self):
+        await close_hooks_client()
+        await self.redis.flushall()
+        await self.redis.aclose()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        return httpx.Response(self.status_code)
+
+    def make_webhook(self, **kwargs) -> Webhook:
+        return Webhook(Channel.telegram, "alarms", json={"channel_ids": [1]}, **kwargs)
+
+    async def send(self, webhook: Webhook) -> DeliveryOutcome:
+        return await async_send_webhook(self.redis, webhook, self.settings)
+
+    async def get_dead_letters(self) -> list[Webhook]:
+        letters = await self.redis.lrange(rk.webhooks_dead_letters, 0, -1)
+        return [Webhook.from_json(letter) for letter in letters]
+
+    async def test_sent(self):
+        webhook = self.make_webhook()
+        self.assertEqual(await self.send(webhook), DeliveryOutcome.sent)
+        self.assertEqual(str(self.requests[0].url), f"{CHANNEL_URL}/alarms")
+        self.assertEqual(json.loads(self.requests[0].content), {"channel_ids": [1]})
+        self.assertEqual(await self.redis.hlen(rk.webhooks_outbox), 0)
+
+    def test_retry_delay(self):
+        for attempts, delay in [(1, 10), (2, 20), (3, 40), (10, 40)]:
+            retry_delay = get_retry_delay(attempts, self.settings)
+            self.assertGreaterEqual(retry_delay, delay / 2)
+            self.assertLessEqual(retry_delay, delay)
+
+    async def test_retry(self):
+        self.status_code = 503
+        webhook = self.make_webhook()
+        sent_at = time.time()
+        self.assertEqual(await self.send(webhook), DeliveryOutcome.retry)
+        data = await self.redis.hget(rk.webhooks_outbox, webhook.id)
+        stored = Webhook.from_json(data)
+        self.assertEqual(stored.attempts, 1)
+        self.assertEqual(stored.error, "503 Service Unavailable")
+
+        # the first retry is after backoff_base with jitter
+        retry_at = await self.redis.zscore(rk.webhooks_schedule, webhook.id)
+        self.assertGreaterEqual(retry_at, sent_at + 5)
+        self.assertLessEqual(retry_at, time.time() + 10)
+
+        # webhook is dead after max_attempts
+        self.settings.circuit_threshold = 10
+        for _ in range(2):
+            self.assertEqual(await self.send(stored), DeliveryOutcome.retry)
+        self.assertEqual(await self.redis.hlen(rk.webhooks_outbox), 0)
+        self.assertEqual(await self.redis.zcard(rk.webhooks_schedule), 0)
+        dead_letters = await self.get_dead_letters()
+        self.assertEqual([letter.id for letter in dead_letters], [webhook.id])
+        self.assertEqual(dead_letters[0].attempts, 3)
+
+    async def test_failed(self):
+        self.status_code = 400
+        webhook = self.make_webhook()
+        self.assertEqual(await self.send(webhook), DeliveryOutcome.failed)
+        self.assertEqual(await self.redis.hlen(rk.webhooks_outbox), 0)
+        dead_letters = await self.get_dead_letters()
+        self.assertEqual([letter.id for letter in dead_letters], [webhook.id])
+        self.assertEqual(dead_letters[0].error, "400 Bad Request")
+        # rejected webhook doesn't open circuit
+        circuit_key = rk.webhooks_circuit(Channel.telegram)
+        self.assertFalse(await self.redis.exists(circuit_key))
+
+    async def test_expired(self):
+        webhook = self.make_webhook(expire_at=time.time() - 1)
+        self.assertEqual(await self.send(webhook), DeliveryOutcome.failed)
+        self.assertEqual(self.requests, [])
+        self.assertEqual(len(await self.get_dead_letters()), 1)
+
+    async def test_circuit_breaker(self):
+        circuit_key = rk.webhooks_circuit(Channel.telegram)
+        self.status_code = 503
+        for _ in range(2):
+            await self.send(self.make_webhook())
+        open_until = float(await self.redis.hget(circuit_key, "open_until"))
+        self.assertGreater(open_until, time.time())
+
+        # channel isn't called, while circuit is open
+        webhook = self.make_webhook()
+        self.assertEqual(await self.send(webhook), DeliveryOutcome.postponed)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(
+            await self.redis.zscore(rk.webhooks_schedule, webhook.id), open_until
+        )
+        self.assertEqual(webhook.attempts, 0)
+
+        # webhook, which can't wait for circuit to close, is dead
+        expiring = self.make_webhook(expire_at=open_until - 1)
+        self.assertEqual(await self.send(expiring), DeliveryOutcome.failed)
+        self.assertEqual(len(self.requests), 2)
+
+        # success after cooldown closes circuit
+        await self.redis.hset(circuit_key, "open_until", time.time() - 1)
+        self.status_code = 200
+        self.assertEqual(await self.send(webhook), DeliveryOutcome.sent)
+        self.assertFalse(await self.redis.exists(circuit_key))
+        self.assertIsNone(await self.redis.hget(rk.webhooks_outbox, webhook.id))
+
+    async def test_dispatch_outbox(self):
+        due = [self.make_webhook() for _ in range(3)]
+        for webhook in due:
+            await async_enqueue_webhook(self.redis, webhook, time.time() - 1)
+        later = self.make_webhook()
+        await async_enqueue_webhook(self.redis, later, time.time() + 60)
+
+        self.assertEqual(await dispatch_outbox(self.redis, self.settings), 3)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(await self.redis.hkeys(rk.webhooks_outbox), [later.id])
+        self.assertEqual(await dispatch_outbox(self.redis, self.settings), 0)
+
+    async def test_dispatch_lease(self):
+        self.status_code = 503
+        webhook = self.make_webhook()
+        await async_enqueue_webhook(self.redis, webhook, time.time() - 1)
+        # webhook claimed by dispatcher, which died, is hidden until lease ends
+        claimed_at = time.time()
+        claim_webhooks = self.redis.register_script(webhooks.CLAIM_WEBHOOKS_SCRIPT)
+        await claim_webhooks(
+            keys=[rk.webhooks_schedule, rk.webhooks_outbox],
+            args=[claimed_at, 10, self.settings.lease],
+        )
+        self.assertEqual(await dispatch_outbox(self.redis, self.settings), 0)
+        self.assertEqual(self.requests, [])
+        self.assertEqual(
+            await self.redis.zscore(rk.webhooks_schedule, webhook.id),
+            claimed_at + self.settings.lease,
+        )
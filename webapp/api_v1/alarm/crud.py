@@ -8,12 +8,14 @@ from webapp.core.models import JournalEntry, User
 
 
 async def update_alarm(
-    session: AsyncSession, user: User, alarm: str | None
+    session: AsyncSession, user: User, alarm: str | None, timezone: str | None
 ) -> UserAlarmSchema:
     user.alarm = alarm
+    user.timezone = timezone
     await session.commit()
     return UserAlarmSchema(
         alarm=user.alarm,
+        timezone=user.timezone,
         user=UserChannelSchema(
             channel=Channel(user.channel), channel_id=user.channel_id
         ),
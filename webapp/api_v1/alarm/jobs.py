@@ -2,12 +2,17 @@ from redis.asyncio import Redis as AsyncRedis
 
 from common.constants import Channel
 from webapp.core.models import User
-from webapp.core.redis import AlarmActions, AlarmTaskInfo, RedisKeys
+from webapp.core.redis import AlarmActions, AlarmTaskInfo, RedisKeys, enqueue_tasks
+from webapp.core.settings import settings
 
 
 async def enqueue_alarm_job(redis: AsyncRedis, action: AlarmActions, user: User, alarm: str) -> int:
-    task_key = AlarmTaskInfo(action, Channel(user.channel), user.channel_id, alarm)
-    return await redis.rpush(RedisKeys.alarms_queue, task_key.to_str())
+    task_key = AlarmTaskInfo(
+        action, Channel(user.channel), user.channel_id, alarm, user.timezone
+    )
+    return await enqueue_tasks(
+        redis, RedisKeys.alarms_queue, [task_key.to_str()], settings.queues.max_len
+    )
 
 
 async def enqueue_alarm_deleting(redis: AsyncRedis, user: User) -> int:
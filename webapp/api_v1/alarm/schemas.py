@@ -1,5 +1,6 @@
 import datetime
 from typing import Annotated
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from fastapi import HTTPException, status
 from pydantic import AfterValidator, BaseModel
@@ -22,11 +23,28 @@ def validate_time(time: str | None) -> str | None:
     return time
 
 
+def validate_timezone(timezone: str | None) -> str | None:
+    if timezone is None:
+        return None
+
+    try:
+        ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "Unknown timezone. Expected IANA timezone name, e.g. 'Europe/Moscow'",
+        )
+    return timezone
+
+
 FormattedTime = Annotated[str | None, AfterValidator(validate_time)]
+Timezone = Annotated[str | None, AfterValidator(validate_timezone)]
 
 
 class UserAlarmSchema(UserMixinSchema):
     alarm: FormattedTime
+    # alarm time is in Moscow time if no timezone is set
+    timezone: Timezone = None
 
 
 class IsNewUserSchema(BaseModel):
@@ -24,7 +24,7 @@ async def set_alarm(
     if user.alarm:
         await enqueue_alarm_deleting(redis, user)
 
-    result = await update_alarm(session, user, body.alarm)
+    result = await update_alarm(session, user, body.alarm, body.timezone)
     if body.alarm:
         await enqueue_alarm_setting(redis, user, body.alarm)
 
@@ -5,7 +5,12 @@ from redis.asyncio import Redis as AsyncRedis
 from common.constants import ENTRY_DATE_FORMAT, Channel
 from webapp.core import settings
 from webapp.core.models import User
-from webapp.core.redis import RedisKeys, ReportTaskInfo, ReportRequester
+from webapp.core.redis import RedisKeys, ReportTaskInfo, ReportRequester, enqueue_tasks
+
+
+async def bump_entries_version(redis: AsyncRedis, user: User) -> int:
+    """Makes cached reports of user stale"""
+    return await redis.hincrby(RedisKeys.entries_versions, str(user.id), 1)
 
 
 async def enqueue_report_order(
@@ -28,4 +33,9 @@ async def enqueue_report_order(
         end_date,
     )
 
-    return await redis.rpush(RedisKeys.reports_queue, task_key.to_str())
+    return await enqueue_tasks(
+        redis,
+        RedisKeys.reports_queue,
+        [task_key.to_str()],
+        settings.queues.max_len,
+    )
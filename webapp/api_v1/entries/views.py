@@ -10,7 +10,7 @@ from webapp.api_v1.common_dependencies import (
     SessionDep,
 )
 from webapp.api_v1.entries.crud import get_entry, write_entry
-from webapp.api_v1.entries.jobs import enqueue_report_order
+from webapp.api_v1.entries.jobs import bump_entries_version, enqueue_report_order
 from webapp.api_v1.entries.schemas import (
     EntryBaseSchema,
     EntrySaveSchema,
@@ -25,9 +25,11 @@ router = APIRouter(prefix="/entries", tags=["entries"])
 async def save_entry(
     body: EntrySaveSchema,
     session: SessionDep,
+    redis: RedisDep,
     user: EnsureUserBodyDep,
 ) -> EntryBaseSchema:
     db_entry = await write_entry(session, user.id, body)
+    await bump_entries_version(redis, user)
     return EntryBaseSchema(date=db_entry.date, entry=db_entry.entry)
 
 
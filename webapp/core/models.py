@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey
+from sqlalchemy import Connection, ForeignKey, inspect, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -14,6 +14,7 @@ class User(Base):
     channel: Mapped[str] = mapped_column(index=True)
     channel_id: Mapped[int] = mapped_column(index=True)
     alarm: Mapped[str | None]
+    timezone: Mapped[str | None]
 
     entries: Mapped[list["JournalEntry"]] = relationship(
         "JournalEntry", back_populates="user", lazy=True, cascade="all, delete-orphan"
@@ -28,3 +29,36 @@ class JournalEntry(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
 
     user: Mapped["User"] = relationship(back_populates="entries", lazy=True)
+
+
+def add_missing_columns(connection: Connection):
+    """create_all doesn't alter existing tables, so new nullable columns
+    are added here"""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            column_type = column.type.compile(connection.dialect)
+            connection.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+            )
+
+
+def enable_incremental_vacuum(connection: Connection):
+    """Lets db_vacuum_task shrink sqlite db file in small steps. Existing db is
+    converted by full vacuum once, so connection must be in autocommit mode."""
+    if connection.dialect.name != "sqlite":
+        return
+
+    # 2 is incremental
+    if connection.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+        return
+
+    connection.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+    connection.execute(text("VACUUM"))
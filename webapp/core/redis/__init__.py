@@ -1,17 +1,23 @@
 __all__ = (
     "AlarmActions",
+    "AlarmIndexEntry",
     "AlarmTaskInfo",
     "RedisHelper",
     "RedisKeys",
+    "StreamEntry",
+    "TaskStream",
     "ReportTaskInfo",
     "ReportRequester",
+    "enqueue_tasks",
 )
 
 from .redis_constants import (
     AlarmActions,
+    AlarmIndexEntry,
     AlarmTaskInfo,
     RedisKeys,
     ReportTaskInfo,
     ReportRequester,
 )
 from .redis_helper import RedisHelper
+from .task_stream import StreamEntry, TaskStream, enqueue_tasks
@@ -2,6 +2,7 @@ from collections import namedtuple
 from datetime import datetime
 from enum import StrEnum, auto
 from typing import Any, Self
+from zoneinfo import ZoneInfo
 
 from common.constants import Channel, TIME_FMT, ReportRequester
 
@@ -10,29 +11,74 @@ class RedisKeys:
 
     # str
     __webhooks_url = "webhooks:{}-url"
+    scheduler_init_lock = "scheduler:init-lock"
+    reports_cache_size = "reports:cache-size"  # bytes of cached reports
+    alarms_group = "alarms-workers"  # consumer group of alarms_queue
+    reports_group = "reports-workers"  # consumer group of reports_queue
 
     # hmap
-    scheduler_jobs = "scheduler:jobs"  # job_id: pickled job
-    alarms_job = "alarms:jobs"  # time: job_id
+    scheduler_jobs = "scheduler:jobs"  # job_id: json encoded job
+    scheduler_intervals = "scheduler:intervals"  # job_id: interval in seconds
+    webhooks_outbox = "webhooks:outbox"  # message_id: json encoded webhook
+    reports_rollout = "reports:rollout"  # start, end, total, released reports
+    reports_cache = "reports:cache"  # digest: rendered report
+    entries_versions = "entries:versions"  # user_id: version of user's entries
+    alarms_job = "alarms:jobs"  # legacy, time: job_id of per-time alarm job
 
     # sorted set
     scheduler_runtimes = "scheduler:runtimes"  # job_id: timestamp
+    scheduler_instances = "scheduler:instances"  # instance_id: heartbeat timestamp
+    webhooks_schedule = "webhooks:schedule"  # message_id: next attempt timestamp
+    reports_delayed = "reports:delayed"  # report task: release timestamp
+    reports_cache_lru = "reports:cache-lru"  # digest: last access timestamp
+
+    # stream, consumed by groups
+    alarms_queue = "alarms:tasks"  # task: alarm task info
+    reports_queue = "reports:tasks"  # task: report task info
+    alarms_dead_letters = "alarms:dead-tasks"  # id, reason, task
+    reports_dead_letters = "reports:dead-tasks"  # id, reason, task
 
     # list
-    alarms_queue = "alarms:queue"
-    reports_queue = "reports:queue"
+    alarms_legacy_queue = "alarms:queue"  # legacy, migrated to alarms_queue
+    reports_legacy_queue = "reports:queue"  # legacy, migrated to reports_queue
+    webhooks_dead_letters = "webhooks:dead-letters"  # undelivered webhooks
+
+    # pub/sub channel
+    scheduler_wakeup = "scheduler:wakeup"  # published on every jobs change
 
     # set
-    __alarms_users = "alarms:{}:{}"  # users subbed to alarm
+    __alarms_users = "alarms:{}:{}"  # users subbed to alarm at utc time
+
+    # hmap
+    __alarms_index = "alarms:index:{}"  # channel_id: alarm index entry
+    __scheduler_metrics = "scheduler:metrics:{}"  # metric: value of scheduler instance
+    __reports_metrics = "reports:metrics:{}"  # metric: value of reports dispatcher
+    __webhooks_circuit = "webhooks:{}-circuit"  # failures, open_until of channel
 
     @classmethod
     def alarms_users(cls, channel: str, time: str) -> str:
         return cls.__alarms_users.format(channel, time)
 
+    @classmethod
+    def alarms_index(cls, channel: str) -> str:
+        return cls.__alarms_index.format(channel)
+
+    @classmethod
+    def scheduler_metrics(cls, instance_id: str) -> str:
+        return cls.__scheduler_metrics.format(instance_id)
+
+    @classmethod
+    def reports_metrics(cls, instance_id: str) -> str:
+        return cls.__reports_metrics.format(instance_id)
+
     @classmethod
     def webhooks_url(cls, channel: str) -> str:
         return cls.__webhooks_url.format(channel)
 
+    @classmethod
+    def webhooks_circuit(cls, channel: str) -> str:
+        return cls.__webhooks_circuit.format(channel)
+
 
 class AlarmActions(StrEnum):
     add = auto()
@@ -47,10 +93,26 @@ _ReportTaskInfo = namedtuple(
 
 _AlarmTaskInfo = namedtuple(
     "_AlarmTaskInfo",
-    ["action", "channel", "channel_id", "alarm"],
+    ["action", "channel", "channel_id", "alarm", "timezone"],
+    defaults=[None],
+)
+
+
+_AlarmIndexEntry = namedtuple(
+    "_AlarmIndexEntry",
+    ["bucket", "alarm", "timezone", "version"],
+    defaults=[""],
 )
 
 
+def _parse_timezone(timezone: str) -> str | None:
+    if timezone == str(None):
+        return None
+
+    ZoneInfo(timezone)  # check timezone exists
+    return timezone
+
+
 class TaskInfo:
 
     @classmethod
@@ -94,7 +156,12 @@ class ReportTaskInfo(_ReportTaskInfo, TaskInfo):
 class AlarmTaskInfo(_AlarmTaskInfo, TaskInfo):
 
     def __init__(
-        self, action: AlarmActions, channel: Channel, channel_id: int, alarm: str
+        self,
+        action: AlarmActions,
+        channel: Channel,
+        channel_id: int,
+        alarm: str,
+        timezone: str | None = None,
     ): ...
 
     @classmethod
@@ -105,6 +172,30 @@ class AlarmTaskInfo(_AlarmTaskInfo, TaskInfo):
             splitted[1] = Channel(splitted[1])  # channel
             splitted[2] = int(splitted[2])  # channel_id
             datetime.strptime(splitted[3], TIME_FMT)  # check time conforms to format
+            if len(splitted) > 4:
+                splitted[4] = _parse_timezone(splitted[4])
+
+            return cls(*splitted)
+        except Exception:
+            pass
+
+        return None
+
+
+class AlarmIndexEntry(_AlarmIndexEntry, TaskInfo):
+    """User's alarm in alarm index, `bucket` is utc time of the next alarm,
+    `version` is id of the last alarm task applied to entry. Entry without
+    alarm is left by removal, so older tasks reclaimed later are skipped."""
+
+    def __init__(
+        self, bucket: str, alarm: str, timezone: str | None, version: str = ""
+    ): ...
+
+    @classmethod
+    def from_str(cls, info: str) -> Self | None:
+        try:
+            splitted: list[Any] = info.split(";")
+            splitted[2] = _parse_timezone(splitted[2])
 
             return cls(*splitted)
         except Exception:
@@ -0,0 +1,177 @@
+import logging
+import os
+import platform
+import time
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import ResponseError
+
+from webapp.core.settings import QueuesSettings
+
+TASK_FIELD = "task"
+
+# Moves entries to dead letters stream. Entry is moved only if it was acked,
+# so entry reclaimed by several consumers at once is moved only once.
+# KEYS: stream, dead letters stream
+# ARGV: group, dead letters max length, reason, entry ids...
+# Returns number of moved entries
+BURY_ENTRIES_SCRIPT = """
+local buried = 0
+for i = 4, #ARGV do
+    if redis.call('XACK', KEYS[1], ARGV[1], ARGV[i]) == 1 then
+        local entry = redis.call('XRANGE', KEYS[1], ARGV[i], ARGV[i])
+        if #entry > 0 then
+            redis.call(
+                'XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*',
+                'id', ARGV[i], 'reason', ARGV[3], unpack(entry[1][2])
+            )
+        end
+        redis.call('XDEL', KEYS[1], ARGV[i])
+        buried = buried + 1
+    end
+end
+return buried
+"""
+
+# (entry id, task)
+StreamEntry = tuple[str, str]
+
+
+async def enqueue_tasks(
+    redis: AsyncRedis, stream: str, tasks: list[str], max_len: int
+) -> int:
+    """Adds tasks to stream, the oldest entries are trimmed above `max_len`"""
+    async with redis.pipeline(transaction=False) as pipe:
+        for task in tasks:
+            pipe.xadd(stream, {TASK_FIELD: task}, maxlen=max_len, approximate=True)
+        await pipe.execute()
+    return len(tasks)
+
+
+class TaskStream:
+    """Tasks queue on redis stream read by consumer group. Task stays pending
+    until it's acked, tasks of dead consumers are reclaimed after `claim_idle`,
+    tasks delivered `max_deliveries` times are moved to dead letters."""
+
+    def __init__(
+        self,
+        redis: AsyncRedis,
+        stream: str,
+        dead_letters: str,
+        group: str,
+        queues_settings: QueuesSettings,
+    ) -> None:
+        self.redis = redis
+        self.stream = stream
+        self.dead_letters = dead_letters
+        self.group = group
+        self.consumer = f"{platform.node()}-{os.getpid()}"
+        self._settings = queues_settings
+        self._bury_entries = redis.register_script(BURY_ENTRIES_SCRIPT)
+        self._reclaimed_at = 0.0
+
+    async def start(self, legacy_queue: str | None = None):
+        """Creates consumer group and moves tasks left in legacy list queue"""
+        try:
+            await self.redis.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as ex:
+            if "BUSYGROUP" not in str(ex):
+                raise
+
+        if not legacy_queue:
+            return
+
+        migrated = 0
+        while tasks := await self.redis.lpop(legacy_queue, 1000):
+            migrated += await enqueue_tasks(
+                self.redis, self.stream, tasks, self._settings.max_len
+            )
+        if migrated:
+            logging.info(f"{migrated} tasks were moved from {legacy_queue}")
+
+    async def stop(self):
+        """Removes consumer from group, if it has no pending tasks"""
+        pending = await self.redis.xpending_range(
+            self.stream, self.group, "-", "+", 1, consumername=self.consumer
+        )
+        if not pending:
+            await self.redis.xgroup_delconsumer(self.stream, self.group, self.consumer)
+
+    async def read(self, count: int, block: float) -> list[StreamEntry]:
+        """Returns up to `count` reclaimed or new tasks, waits for new tasks
+        no longer than `block` seconds"""
+        entries: list[StreamEntry] = []
+        if time.monotonic() - self._reclaimed_at >= self._settings.claim_interval:
+            self._reclaimed_at = time.monotonic()
+            entries = await self.reclaim(count)
+            if entries:
+                return entries
+
+        response = await self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=count,
+            block=max(int(block * 1000), 1),
+        )
+        for _, stream_entries in response:
+            entries.extend(self._parse_entries(stream_entries))
+        return entries
+
+    async def reclaim(self, count: int) -> list[StreamEntry]:
+        """Takes over tasks, which weren't acked for `claim_idle` seconds"""
+        min_idle = int(self._settings.claim_idle * 1000)
+        stale = await self.redis.xpending_range(
+            self.stream, self.group, "-", "+", count, idle=min_idle
+        )
+        exhausted = [
+            entry["message_id"]
+            for entry in stale
+            if entry["times_delivered"] >= self._settings.max_deliveries
+        ]
+        if exhausted:
+            buried = await self.bury(exhausted, "max deliveries")
+            logging.error(f"{buried} tasks of {self.stream} were moved to dead letters")
+
+        _, claimed, *_ = await self.redis.xautoclaim(
+            self.stream, self.group, self.consumer, min_idle, count=count
+        )
+        entries = self._parse_entries(claimed)
+        if entries:
+            logging.warning(f"{len(entries)} stale tasks of {self.stream} reclaimed")
+        return entries
+
+    async def ack(self, entry_ids: list[str]):
+        """Marks tasks as handled and removes them from stream"""
+        if not entry_ids:
+            return
+
+        async with self.redis.pipeline() as pipe:
+            pipe.xack(self.stream, self.group, *entry_ids)
+            pipe.xdel(self.stream, *entry_ids)
+            await pipe.execute()
+
+    async def bury(self, entry_ids: list[str], reason: str) -> int:
+        """Moves tasks, which can't be handled, to dead letters"""
+        if not entry_ids:
+            return 0
+
+        return await self._bury_entries(
+            keys=[self.stream, self.dead_letters],
+            args=[self.group, self._settings.dead_letters_len, reason, *entry_ids],
+        )
+
+    async def get_backlog(self) -> int:
+        """Returns number of not acked tasks"""
+        return await self.redis.xlen(self.stream)
+
+    @staticmethod
+    def _parse_entries(stream_entries: list) -> list[StreamEntry]:
+        # deleted entries are returned without fields
+        return [
+            (entry_id, fields[TASK_FIELD])
+            for entry_id, fields in stream_entries
+            if fields and TASK_FIELD in fields
+        ]
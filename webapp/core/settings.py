@@ -59,12 +59,77 @@ class TestRedisSettings(RedisSettings):
     db: int = Field(default=1, alias="redis_test_db")
 
 
+class SchedulerSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="hpj_scheduler_")
+
+    max_running_jobs: int = 100
+    # task name: max running jobs of the task
+    task_limits: dict[str, int] = {
+        "alarm_wheel_task": 5,
+        "alarms_rebucket_task": 1,
+        "weekly_report_task": 1,
+        "db_cleaner_task": 1,
+        "db_vacuum_task": 1,
+        "webhooks_outbox_task": 1,
+        "reports_rollout_task": 1,
+    }
+    # seconds, used if job has no own timeout
+    job_timeout: float = 10 * 60
+    # alarm wheel leaves chunks it can't send in time to outbox, timeout is
+    # a safety net and covers the last chunks requests
+    task_timeouts: dict[str, float] = {"alarm_wheel_task": 90}
+    # minutes, weekly reports are spread over the window, 0 to order them at once
+    reports_window: int = 60
+    # max reports ordered per minute, window is extended if there are more reports
+    reports_rate: int = 500
+
+
+class OutboxSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="hpj_outbox_")
+
+    max_attempts: int = 8
+    # seconds, retry delay doubles with every attempt up to backoff_cap
+    backoff_base: float = 5
+    backoff_cap: float = 15 * 60
+    # failures in a row, after which channel isn't called for circuit_cooldown
+    circuit_threshold: int = 5
+    circuit_cooldown: float = 60
+    # seconds, claimed webhook is hidden from other dispatchers
+    lease: float = 2 * 60
+    dispatch_batch: int = 100
+    dispatch_parallel: int = 8
+    dead_letters_limit: int = 1000
+
+
+class QueuesSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="hpj_queues_")
+
+    # tasks streams are trimmed approximately to this length
+    max_len: int = 100_000
+    # seconds, not acked task is taken over by another worker after claim_idle
+    claim_idle: float = 5 * 60
+    claim_interval: float = 30
+    max_deliveries: int = 5
+    dead_letters_len: int = 10_000
+
+
+class ReportsCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="hpj_reports_cache_")
+
+    # bytes of rendered reports kept in redis, 0 to disable cache
+    max_size: int = 64 * 1024 * 1024
+
+
 class Settings(BaseSettings):
     api_v1_prefix: str = "/api/v1"
     db: DbSettings = DbSettings()
     auth: AuthSettings = AuthSettings()
     jinja: JinjaSettings = JinjaSettings()
     redis: RedisSettings = RedisSettings()
+    scheduler: SchedulerSettings = SchedulerSettings()
+    outbox: OutboxSettings = OutboxSettings()
+    queues: QueuesSettings = QueuesSettings()
+    reports_cache: ReportsCacheSettings = ReportsCacheSettings()
     entry_store_days: int = 60
 
 
@@ -5,13 +5,17 @@ from fastapi import Depends, FastAPI
 from common.utils import check_jwt_token_dep
 from webapp.api_v1 import APIv1_Router, WebHooksOpenApiDocsRouter
 from webapp.core import db_helper
-from webapp.core.models import Base
+from webapp.core.models import Base, add_missing_columns, enable_incremental_vacuum
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     async with db_helper.async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+    async with db_helper.async_engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.run_sync(enable_incremental_vacuum)
     yield
 
 
@@ -1,4 +1,6 @@
+import json
 from datetime import datetime
+from hashlib import sha256
 from pathlib import Path
 
 from jinja2 import Environment, FileSystemLoader
@@ -22,9 +24,19 @@ class HTMLGenerator(IFileGenerator):
             folder_path (str | Path): Path to folder with templates.
             template_name (str): Template file name.
         """
-        self._env = Environment(loader=FileSystemLoader(folder_path, encoding="utf-8"))
+        loader = FileSystemLoader(folder_path, encoding="utf-8")
+        self._env = Environment(loader=loader)
         self._template = self._env.get_template(template_name)
         self._questions = questions
+        source, _, _ = loader.get_source(self._env, template_name)
+        self._version = sha256(
+            (source + json.dumps(questions, sort_keys=True)).encode()
+        ).hexdigest()[:16]
+
+    @property
+    def version(self) -> str:
+        """Digest of template and questions, changes when generated file changes."""
+        return self._version
 
     def _prepare_render_params(self, replies: dict):
         """Prepares data for template."""
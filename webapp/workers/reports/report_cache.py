@@ -0,0 +1,83 @@
+"""Cache of rendered reports.
+
+Reports are keyed by digest of user, date range, version of user's entries
+and template version. Entries version is bumped by api on every entry write,
+so changed entries get new digest and stale reports are just evicted by LRU.
+"""
+
+import time
+from hashlib import sha256
+from typing import Sequence
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+from webapp.core.redis import RedisKeys as rk
+from webapp.core.redis import ReportTaskInfo
+
+# Adds reports to cache and evicts the least recently used ones, until
+# cache size is under the limit.
+# KEYS: cache hash, lru zset, cache size counter
+# ARGV: current timestamp, max cache size in bytes, then digest, report pairs
+# Returns number of evicted reports
+CACHE_REPORTS_SCRIPT = """
+local max_size = tonumber(ARGV[2])
+for i = 3, #ARGV, 2 do
+    if redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1]) == 1 then
+        redis.call('INCRBY', KEYS[3], string.len(ARGV[i + 1]))
+    end
+    redis.call('ZADD', KEYS[2], ARGV[1], ARGV[i])
+end
+local evicted = 0
+while tonumber(redis.call('GET', KEYS[3]) or 0) > max_size do
+    local oldest = redis.call('ZPOPMIN', KEYS[2])
+    if #oldest == 0 then
+        -- size counter drifted, e.g. after concurrent clear
+        redis.call('DEL', KEYS[1], KEYS[3])
+        break
+    end
+    redis.call('DECRBY', KEYS[3], redis.call('HSTRLEN', KEYS[1], oldest[1]))
+    redis.call('HDEL', KEYS[1], oldest[1])
+    evicted = evicted + 1
+end
+return evicted
+"""
+
+
+def get_report_digests(
+    redis: Redis, infos: Sequence[ReportTaskInfo], template_version: str
+) -> list[str]:
+    versions = redis.hmget(rk.entries_versions, [info.user_id for info in infos])
+    digests = []
+    for info, version in zip(infos, versions):
+        key = (info.user_id, info.start, info.end, version or 0, template_version)
+        digests.append(sha256(":".join(map(str, key)).encode()).hexdigest())
+    return digests
+
+
+def get_cached_reports(redis: Redis, digests: list[str]) -> list[str | None]:
+    """Returns cached reports, empty string is report without entries"""
+    with redis.pipeline() as pipe:
+        pipe.hmget(rk.reports_cache, digests)
+        # only cached reports are touched
+        pipe.zadd(rk.reports_cache_lru, dict.fromkeys(digests, time.time()), xx=True)
+        reports, _ = pipe.execute()
+    return reports
+
+
+def cache_reports(redis: Redis, reports: dict[str, str], max_size: int) -> int:
+    """Caches reports by digests. Returns number of evicted reports"""
+    if not reports:
+        return 0
+
+    args: list[str | float] = [time.time(), max_size]
+    for digest, report in reports.items():
+        args += [digest, report]
+    return redis.register_script(CACHE_REPORTS_SCRIPT)(
+        keys=[rk.reports_cache, rk.reports_cache_lru, rk.reports_cache_size],
+        args=args,
+    )
+
+
+async def clear_reports_cache(redis: AsyncRedis):
+    await redis.unlink(rk.reports_cache, rk.reports_cache_lru, rk.reports_cache_size)
@@ -1,25 +1,59 @@
+import asyncio
 import json
 import logging
 import multiprocessing
 import os
-from concurrent.futures import Future, ProcessPoolExecutor
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from typing import Sequence
 
 import httpx
+from redis import Redis
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from common.constants import CERTS_DIR, ENTRY_DATE_FORMAT
 from common.survey.hpj_questions import Questions
-from common.utils import concat_url, gen_jwt_token
 from webapp.core import redis_helper
 from webapp.core.db_helper import DatabaseHelper
 from webapp.core.models import JournalEntry
-from webapp.core.redis import RedisKeys, ReportRequester, ReportTaskInfo
-from webapp.core.settings import DbSettings, JinjaSettings, init_test_settings, settings
+from webapp.core.redis import (
+    RedisKeys,
+    ReportRequester,
+    ReportTaskInfo,
+    StreamEntry,
+    TaskStream,
+)
+from webapp.core.settings import (
+    DbSettings,
+    JinjaSettings,
+    OutboxSettings,
+    RedisSettings,
+    ReportsCacheSettings,
+    init_test_settings,
+    settings,
+)
 from webapp.workers.reports.journal_view.html_generator import HTMLGenerator
+from webapp.workers.reports.report_cache import (
+    cache_reports,
+    get_cached_reports,
+    get_report_digests,
+)
 from webapp.workers.utils import GracefulKiller
+from webapp.workers.webhooks import (
+    HOOKS_HTTP2,
+    HOOKS_LIMITS,
+    HOOKS_TIMEOUT,
+    Webhook,
+    send_webhook,
+)
+
+# reports generated by one pool call
+REPORTS_BATCH = 20
+# seconds, batch isn't waited to be full longer
+REPORTS_BATCH_WAIT = 0.05
 
 
 class ProcessLocals:
@@ -29,16 +63,30 @@ class ProcessLocals:
         self._db_helper: DatabaseHelper | None = None
         self._html_generator: HTMLGenerator | None = None
         self._logger: logging.Logger | None = None
+        self._redis: Redis | None = None
+        self._hooks_client: httpx.Client | None = None
         # default settings
         self._db_settings = settings.db
         self._jinja_settings = settings.jinja
+        self._redis_settings = settings.redis
+        self.outbox_settings = settings.outbox
+        self.reports_cache_settings = settings.reports_cache
         self._log_level = logging.DEBUG
 
     def init_settings(
-        self, db_settings: DbSettings, jinja_settings: JinjaSettings, log_level: int
+        self,
+        db_settings: DbSettings,
+        jinja_settings: JinjaSettings,
+        redis_settings: RedisSettings,
+        outbox_settings: OutboxSettings,
+        reports_cache_settings: ReportsCacheSettings,
+        log_level: int,
     ):
         self._db_settings = db_settings
         self._jinja_settings = jinja_settings
+        self._redis_settings = redis_settings
+        self.outbox_settings = outbox_settings
+        self.reports_cache_settings = reports_cache_settings
         self._log_level = log_level
 
     @property
@@ -51,6 +99,29 @@ class ProcessLocals:
             )
         return self._db_helper
 
+    @property
+    def redis(self) -> Redis:
+        if not self._redis:
+            self._redis = Redis(
+                self._redis_settings.host,
+                self._redis_settings.port,
+                self._redis_settings.db,
+                decode_responses=True,
+            )
+        return self._redis
+
+    @property
+    def hooks_client(self) -> httpx.Client:
+        """Keep-alive client, so reports are uploaded through warm connection"""
+        if self._hooks_client is None or self._hooks_client.is_closed:
+            self._hooks_client = httpx.Client(
+                verify=str(CERTS_DIR / "ssl-cert.pem"),
+                http2=HOOKS_HTTP2,
+                timeout=HOOKS_TIMEOUT,
+                limits=HOOKS_LIMITS,
+            )
+        return self._hooks_client
+
     @property
     def html_generator(self) -> HTMLGenerator:
         if not self._html_generator:
@@ -80,43 +151,120 @@ _pl = ProcessLocals()
 
 
 def init_process_worker(
-    db_settings: DbSettings, jinja_settings: JinjaSettings, log_level: int
+    db_settings: DbSettings,
+    jinja_settings: JinjaSettings,
+    redis_settings: RedisSettings,
+    outbox_settings: OutboxSettings,
+    reports_cache_settings: ReportsCacheSettings,
+    log_level: int,
 ):
-    _pl.init_settings(db_settings, jinja_settings, log_level)
+    _pl.init_settings(
+        db_settings,
+        jinja_settings,
+        redis_settings,
+        outbox_settings,
+        reports_cache_settings,
+        log_level,
+    )
 
 
-def read_entries_from_db(
-    session: Session, info: ReportTaskInfo
-) -> Sequence[JournalEntry]:
+def get_report_dates(info: ReportTaskInfo) -> list[str]:
     start_dt = datetime.strptime(info.start, ENTRY_DATE_FORMAT)
     end_dt = datetime.strptime(info.end, ENTRY_DATE_FORMAT)
     delta_days = (end_dt - start_dt).days
-    report_range = [
+    return [
         (end_dt - timedelta(days=i)).strftime(ENTRY_DATE_FORMAT)
         for i in range(delta_days + 1)
     ]
+
+
+def read_users_entries(
+    session: Session, infos: Sequence[ReportTaskInfo]
+) -> dict[int, list[JournalEntry]]:
+    """Reads entries of every report of batch by one query.
+    Returns entries by user_id, they may be out of user's report range."""
+    report_dates: set[str] = set()
+    for info in infos:
+        report_dates.update(get_report_dates(info))
+
     stmt = (
         select(JournalEntry)
-        .where(JournalEntry.user_id == info.user_id)
-        .where(JournalEntry.date.in_(report_range))
+        .where(JournalEntry.user_id.in_({info.user_id for info in infos}))
+        .where(JournalEntry.date.in_(report_dates))
+    )
+    users_entries: dict[int, list[JournalEntry]] = defaultdict(list)
+    for row in session.scalars(stmt):
+        users_entries[row.user_id].append(row)
+    return users_entries
+
+
+def send_report(
+    info: ReportTaskInfo,
+    channel_url: str,
+    data: dict,
+    file: tuple[str, bytes, str] | None = None,
+):
+    """Sends report, it's retried from outbox if channel is unavailable"""
+    webhook = Webhook(info.channel, "reports", data=data, file=file)
+    send_webhook(
+        _pl.redis, _pl.hooks_client, webhook, _pl.outbox_settings, channel_url
     )
-    return session.scalars(stmt).all()
-
-
-def send_report(url: str, data: dict | None, files: dict | None = None):
-    httpx.post(
-        url=url,
-        data=data,
-        files=files,
-        headers={
-            "Authorization": "Bearer "
-            + gen_jwt_token({"issuer": "webapp", "reason": "alarms"})
-        },
-        verify=str(CERTS_DIR / "ssl-cert.pem"),
+
+
+def render_report(info: ReportTaskInfo, entry_rows: Sequence[JournalEntry]) -> str:
+    """Returns rendered report, empty for report without entries"""
+    _pl.logger.debug(f"{len(entry_rows)} rows read from entries.")
+    if not entry_rows:
+        return ""
+
+    out_file = _pl.html_generator.generate(
+        replies={row.date: json.loads(row.entry) for row in entry_rows},
     )
+    return out_file.decode(encoding="utf-8")
+
 
+def render_reports(infos: Sequence[ReportTaskInfo]) -> list[str | None]:
+    """Returns rendered reports. Cached reports are taken without reading
+    entries, others are rendered and cached. Report failed to render is None."""
+    max_size = _pl.reports_cache_settings.max_size
+    reports: list[str | None] = [None] * len(infos)
+    digests: list[str] = []
+    if max_size:
+        digests = get_report_digests(_pl.redis, infos, _pl.html_generator.version)
+        reports = get_cached_reports(_pl.redis, digests)
 
-def generate_report(info: ReportTaskInfo, url: str):
+    missed = [i for i, report in enumerate(reports) if report is None]
+    _pl.logger.debug(f"{len(infos) - len(missed)} of {len(infos)} reports cached")
+    if not missed:
+        return reports
+
+    with _pl.db_helper.session() as session:
+        users_entries = read_users_entries(session, [infos[i] for i in missed])
+
+    rendered: dict[str, str] = {}
+    for i in missed:
+        info = infos[i]
+        report_dates = set(get_report_dates(info))
+        entry_rows = [
+            row
+            for row in users_entries.get(info.user_id, [])
+            if row.date in report_dates
+        ]
+        try:
+            report = render_report(info, entry_rows)
+        except Exception:
+            _pl.logger.exception(f"Report for {info.user_id} wasn't rendered")
+            continue
+
+        reports[i] = report
+        if max_size:
+            rendered[digests[i]] = report
+
+    cache_reports(_pl.redis, rendered, max_size)
+    return reports
+
+
+def make_report(info: ReportTaskInfo, channel_url: str, report: str):
     report_meta = {
         "channel_id": info.channel_id,
         "requester": info.requester,
@@ -124,73 +272,221 @@ def generate_report(info: ReportTaskInfo, url: str):
         "end_date": info.end,
     }
 
-    entry_rows: Sequence[JournalEntry] = []
-    with _pl.db_helper.session() as session:
-        entry_rows = read_entries_from_db(session, info)
-
-    _pl.logger.debug(f"{len(entry_rows)} rows read from entries.")
-    if not entry_rows:
+    if not report:
         # if task was created by channel we need to send empty answer
         if info.requester == ReportRequester.channel:
             _pl.logger.debug("Sending empty report.")
-            send_report(url, report_meta)
+            send_report(info, channel_url, report_meta)
         return
 
-    out_file = _pl.html_generator.generate(
-        replies={row.date: json.loads(row.entry) for row in entry_rows},
-    )
+    out_file = report.encode(encoding="utf-8")
     filename = _pl.html_generator.gen_filename(f"{info.start}-{info.end}")
 
     _pl.logger.debug(f"Generated report {filename}, {len(out_file)} bytes")
     send_report(
-        url, report_meta, files={"file": (filename, out_file, "multipart/form-data")}
+        info, channel_url, report_meta, (filename, out_file, "multipart/form-data")
     )
     _pl.logger.info(f"Report for {info.user_id} was sended")
 
 
-def future_done_callback(fut: Future):
-    if fut.exception():
-        logging.error(fut.exception())
+def generate_reports(tasks: Sequence[tuple[ReportTaskInfo, str]]) -> list[bool]:
+    """Generates batch of reports: entries of not cached reports are read by
+    one query and reports are uploaded through process keep-alive client.
+    Failed report doesn't stop others. Returns whether every report was sent."""
+    reports = render_reports([info for info, _ in tasks])
+
+    sent = []
+    for (info, channel_url), report in zip(tasks, reports):
+        if report is None:
+            sent.append(False)
+            continue
+
+        try:
+            make_report(info, channel_url, report)
+            sent.append(True)
+        except Exception:
+            _pl.logger.exception(f"Report for {info.user_id} failed")
+            sent.append(False)
+
+    return sent
+
+
+async def collect_batch(stream: TaskStream, size: int) -> list[StreamEntry]:
+    """Waits for tasks and collects up to `size` of them, batch isn't waited
+    to be full longer than REPORTS_BATCH_WAIT"""
+    batch = await stream.read(size, block=1)
+    if batch and len(batch) < size:
+        batch += await stream.read(size - len(batch), block=REPORTS_BATCH_WAIT)
+    return batch
+
+
+async def get_batch_tasks(
+    stream: TaskStream, entries: list[StreamEntry]
+) -> tuple[list[str], list[tuple[ReportTaskInfo, str]]]:
+    """Parses tasks and pairs them with urls of their channels. Tasks, which
+    can't be handled, are moved to dead letters. Returns entry ids and tasks."""
+    parsed: list[tuple[str, ReportTaskInfo]] = []
+    broken_ids = []
+    for entry_id, task_key in entries:
+        if info := ReportTaskInfo.from_str(task_key):
+            parsed.append((entry_id, info))
+        else:
+            logging.error(f'Can\'t parse task info: "{task_key}"')
+            broken_ids.append(entry_id)
+
+    channels = list({info.channel for _, info in parsed})
+    channels_urls = dict(
+        zip(
+            channels,
+            await stream.redis.mget([RedisKeys.webhooks_url(ch) for ch in channels]),
+        )
+    )
+    entry_ids = []
+    tasks = []
+    for entry_id, info in parsed:
+        if channel_url := channels_urls[info.channel]:
+            entry_ids.append(entry_id)
+            tasks.append((info, channel_url))
+        else:
+            logging.error(
+                f"No url registered for {info.channel}, but report was requested"
+            )
+            broken_ids.append(entry_id)
+
+    await stream.bury(broken_ids, "invalid task")
+    return entry_ids, tasks
+
+
+class DispatcherMetrics:
+    """Gauges and counters of reports dispatcher"""
+
+    def __init__(self, max_in_flight: int) -> None:
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        # not acked tasks in reports stream
+        self.backlog = 0
+        self.done = 0
+        self.failed = 0
+
+    def to_dict(self) -> dict[str | bytes, int]:
+        # redis stubs expect str | bytes keys
+        return dict(vars(self).items())
 
 
-def worker(worker_count: int = 4, test_config: bool = False):
+class ReportsDispatcher:
+    """Hands report tasks to process pool. Tasks are read from stream only
+    when pool has free slots, so backlog stays in redis instead of executor
+    queue. Tasks are acked after they're sent, not acked ones are reclaimed
+    by any dispatcher after claim_idle."""
+
+    # seconds
+    __metrics_interval: float = 10
+
+    def __init__(self, pool: ProcessPoolExecutor, max_in_flight: int) -> None:
+        self._pool = pool
+        self._running: set[asyncio.Task] = set()
+        self.metrics = DispatcherMetrics(max_in_flight)
+
+    def _free_slots(self) -> int:
+        return self.metrics.max_in_flight - self.metrics.in_flight
+
+    async def _handle_batch(
+        self,
+        stream: TaskStream,
+        entry_ids: list[str],
+        tasks: list[tuple[ReportTaskInfo, str]],
+    ):
+        """Tasks are counted in flight by caller before batch is scheduled,
+        so the next read doesn't see their slots as free"""
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                sent = await loop.run_in_executor(self._pool, generate_reports, tasks)
+            except Exception as ex:
+                logging.error(f"Reports batch failed: {ex!r}")
+                sent = [False] * len(tasks)
+
+            await stream.ack([entry_id for entry_id, ok in zip(entry_ids, sent) if ok])
+            self.metrics.done += sent.count(True)
+            self.metrics.failed += sent.count(False)
+        finally:
+            self.metrics.in_flight -= len(tasks)
+
+    async def publish_metrics(self, stream: TaskStream):
+        self.metrics.backlog = await stream.get_backlog()
+        metrics_key = RedisKeys.reports_metrics(stream.consumer)
+        async with stream.redis.pipeline() as pipe:
+            pipe.hset(metrics_key, mapping=self.metrics.to_dict())
+            pipe.expire(metrics_key, int(3 * self.__metrics_interval))
+            await pipe.execute()
+
+    async def run(self, gk: GracefulKiller):
+        async with redis_helper.async_connection() as redis:
+            stream = TaskStream(
+                redis,
+                RedisKeys.reports_queue,
+                RedisKeys.reports_dead_letters,
+                RedisKeys.reports_group,
+                settings.queues,
+            )
+            await stream.start(RedisKeys.reports_legacy_queue)
+            published_at = 0.0
+            while not gk.exit_now:
+                if time.monotonic() - published_at >= self.__metrics_interval:
+                    await self.publish_metrics(stream)
+                    published_at = time.monotonic()
+
+                if self._free_slots() <= 0:
+                    await asyncio.wait(
+                        self._running, timeout=1, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    continue
+
+                entries = await collect_batch(
+                    stream, min(REPORTS_BATCH, self._free_slots())
+                )
+                entry_ids, tasks = await get_batch_tasks(stream, entries)
+                if tasks:
+                    self.metrics.in_flight += len(tasks)
+                    task = asyncio.create_task(
+                        self._handle_batch(stream, entry_ids, tasks)
+                    )
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+
+            logging.info(f"Waiting for {self.metrics.in_flight} reports in flight")
+            if self._running:
+                await asyncio.wait(self._running)
+            await redis.unlink(RedisKeys.reports_metrics(stream.consumer))
+            await stream.stop()
+
+
+def worker(
+    worker_count: int = 4, test_config: bool = False, prefetch: int = 2 * REPORTS_BATCH
+):
+    """`prefetch` is number of reports taken from queue for every pool process"""
 
     log_level = logging.getLogger().level
     if test_config:
         log_level = logging.DEBUG
         init_test_settings()
 
-    with (
-        ProcessPoolExecutor(
-            worker_count,
-            initializer=init_process_worker,
-            initargs=(settings.db, settings.jinja, log_level),
-        ) as pool,
-        redis_helper.connection() as redis,
-    ):
+    with ProcessPoolExecutor(
+        worker_count,
+        initializer=init_process_worker,
+        initargs=(
+            settings.db,
+            settings.jinja,
+            settings.redis,
+            settings.outbox,
+            settings.reports_cache,
+            log_level,
+        ),
+    ) as pool:
         gk = GracefulKiller()
+        dispatcher = ReportsDispatcher(pool, worker_count * prefetch)
         logging.info("Ready to pickup tasks")
-        while not gk.exit_now:
-            task_key = redis.blpop([RedisKeys.reports_queue], timeout=1)
-            if not task_key:
-                continue
-
-            info = ReportTaskInfo.from_str(task_key[1])
-            if not info:
-                logging.error(f'Can\'t parse task info: "{task_key[1]}"')
-                continue
-
-            channel_url = redis.get(RedisKeys.webhooks_url(info.channel))
-            if not channel_url:
-                logging.error(
-                    f"No url registered for {info.channel}, but report was requested"
-                )
-                continue
-
-            future = pool.submit(
-                generate_report, info, concat_url(channel_url, "reports")
-            )
-            future.add_done_callback(future_done_callback)
+        asyncio.run(dispatcher.run(gk))
 
         logging.info(f"Stopping workers by signal: {gk.signum}")
         pool.shutdown(wait=True)
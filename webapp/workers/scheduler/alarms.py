@@ -0,0 +1,398 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import partial
+from typing import Callable, Iterable, Mapping
+from weakref import WeakKeyDictionary
+from zoneinfo import ZoneInfo
+
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+from common.constants import MSK_TIMEZONE_OFFSET, TIME_FMT, Channel
+from webapp.core.redis import AlarmActions, AlarmIndexEntry, AlarmTaskInfo
+from webapp.core.redis import RedisKeys as rk
+
+# Compare-and-set of alarm index entries, so several alarm consumers and
+# rebucketing can run in parallel. Entry is changed only if it's still the one
+# update was made from, otherwise user is returned as conflicting. Empty entry
+# means missing one, empty new entry removes user from index.
+# KEYS: alarm index hash, then users buckets
+# ARGV: quintuples of channel_id, expected entry, new entry and indexes of old
+# and new buckets in KEYS, 0 if entry has no bucket
+# Returns number of changed users and list of conflicting channel_ids
+UPDATE_ALARMS_SCRIPT = """
+local changed, conflicts = 0, {}
+for i = 1, #ARGV, 5 do
+    local channel_id, expected, entry = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local old_key, new_key = tonumber(ARGV[i + 3]), tonumber(ARGV[i + 4])
+    if (redis.call('HGET', KEYS[1], channel_id) or '') ~= expected then
+        table.insert(conflicts, channel_id)
+    elseif expected ~= entry then
+        if old_key > 0 and old_key ~= new_key then
+            redis.call('SREM', KEYS[old_key], channel_id)
+        end
+        if new_key > 0 then
+            redis.call('SADD', KEYS[new_key], channel_id)
+        end
+        if entry ~= '' then
+            redis.call('HSET', KEYS[1], channel_id, entry)
+        else
+            redis.call('HDEL', KEYS[1], channel_id)
+        end
+        changed = changed + 1
+    end
+end
+return {changed, conflicts}
+"""
+
+# users changed meanwhile are updated again with their current entries
+UPDATE_ALARMS_RETRIES = 3
+
+# takes user's current index entry, returns the new one, None removes user
+AlarmUpdate = Callable[[AlarmIndexEntry | None], AlarmIndexEntry | None]
+
+_update_scripts: WeakKeyDictionary[Redis, AsyncScript] = WeakKeyDictionary()
+
+
+def get_alarm_timezone(timezone_name: str | None) -> tzinfo:
+    return ZoneInfo(timezone_name) if timezone_name else MSK_TIMEZONE_OFFSET
+
+
+def get_alarm_bucket(
+    alarm: str, timezone_name: str | None, date: datetime | None = None
+) -> str:
+    """Returns utc time of the next alarm occurrence after `date`.
+
+    Offset of named timezone may differ from day to day, so bucket is valid
+    until the next occurrence and should be recalculated after it.
+    """
+    tz = get_alarm_timezone(timezone_name)
+    local_now = (date or datetime.now(timezone.utc)).astimezone(tz)
+    alarm_time = datetime.strptime(alarm, TIME_FMT).time()
+
+    next_alarm = datetime.combine(local_now.date(), alarm_time, tzinfo=tz)
+    if next_alarm < local_now:
+        next_alarm = datetime.combine(
+            local_now.date() + timedelta(days=1), alarm_time, tzinfo=tz
+        )
+
+    return next_alarm.astimezone(timezone.utc).strftime(TIME_FMT)
+
+
+def get_entry_version(version: str) -> tuple[int, int]:
+    """Parses stream entry id "ms-seq" of alarm task to compare versions,
+    empty or malformed version is older than any other"""
+    try:
+        ms, _, seq = version.partition("-")
+        return int(ms), int(seq or 0)
+    except ValueError:
+        return 0, 0
+
+
+async def get_index_version(redis: Redis, age: float = 0) -> str:
+    """Returns version newer than all tasks added to alarms stream more than
+    `age` seconds ago, stream entry ids are made of redis time too"""
+    seconds, microseconds = await redis.time()
+    return f"{seconds * 1000 + microseconds // 1000 - int(age * 1000)}-0"
+
+
+def get_removed_entry(version: str) -> AlarmIndexEntry:
+    return AlarmIndexEntry("", "", None, version)
+
+
+def is_removed_entry(entry: AlarmIndexEntry) -> bool:
+    return not entry.alarm
+
+
+class AlarmChange:
+    """Net effect of user's sequence of alarm tasks, `version` is id of the
+    last task. Change is skipped, if index entry is already newer."""
+
+    def __init__(self) -> None:
+        self.new_alarm: AlarmTaskInfo | None = None
+        # current alarm is removed if it's one of these, None to remove any
+        self.removed_alarms: set[str] | None = set()
+        self.version = ""
+
+    def apply(self, info: AlarmTaskInfo, version: str = ""):
+        """Tasks must be applied in order of their versions"""
+        self.version = version
+        if info.action == AlarmActions.add:
+            self.new_alarm, self.removed_alarms = info, set()
+        elif self.new_alarm:
+            if self.new_alarm.alarm == info.alarm:
+                self.new_alarm, self.removed_alarms = None, None
+        elif self.removed_alarms is not None:
+            self.removed_alarms.add(info.alarm)
+
+    def get_entry(
+        self, old_entry: AlarmIndexEntry | None, date: datetime
+    ) -> AlarmIndexEntry | None:
+        """Returns user's index entry after the change. Versioned removal
+        leaves removed entry, so older adds reclaimed later are skipped.
+        Removal without version is applied only if current alarm is the
+        removed one, so stale removals don't drop new alarm."""
+        if (
+            old_entry
+            and self.version
+            and get_entry_version(old_entry.version)
+            >= get_entry_version(self.version)
+        ):
+            return old_entry
+
+        if new_alarm := self.new_alarm:
+            bucket = get_alarm_bucket(new_alarm.alarm, new_alarm.timezone, date)
+            return AlarmIndexEntry(
+                bucket, new_alarm.alarm, new_alarm.timezone, self.version
+            )
+
+        if self.version:
+            return get_removed_entry(self.version)
+        if old_entry is None or self.removed_alarms is None:
+            return None
+        if old_entry.alarm in self.removed_alarms:
+            return None
+        return old_entry
+
+
+def _get_update_script(redis: Redis) -> AsyncScript:
+    # registered once per client, like job store scripts
+    if (update_script := _update_scripts.get(redis)) is None:
+        update_script = redis.register_script(UPDATE_ALARMS_SCRIPT)
+        _update_scripts[redis] = update_script
+    return update_script
+
+
+async def update_alarms(
+    redis: Redis, channel: Channel, updates: Mapping[str, AlarmUpdate]
+) -> int:
+    """Applies channel_id: update to users index entries with
+    UPDATE_ALARMS_SCRIPT, two round trips if nobody changed users meanwhile.
+    Unparsable entries are passed to updates as missing ones.
+    Returns number of changed users."""
+    index_key = rk.alarms_index(channel)
+    update_script = _get_update_script(redis)
+    changed = 0
+    for _ in range(UPDATE_ALARMS_RETRIES):
+        if not updates:
+            return changed
+
+        channel_ids = list(updates)
+        keys = [index_key]
+        keys_indexes: dict[str, int] = {}
+
+        def get_key_index(entry: AlarmIndexEntry | None) -> int:
+            if not entry or not entry.bucket:
+                return 0
+            if entry.bucket not in keys_indexes:
+                keys.append(rk.alarms_users(channel, entry.bucket))
+                keys_indexes[entry.bucket] = len(keys)
+            return keys_indexes[entry.bucket]
+
+        args: list[str | int] = []
+        for channel_id, info in zip(
+            channel_ids, await redis.hmget(index_key, channel_ids)
+        ):
+            old_entry = AlarmIndexEntry.from_str(info) if info else None
+            entry = updates[channel_id](old_entry)
+            new_info = entry.to_str() if entry else ""
+            if new_info == (info or ""):
+                continue
+
+            args += [
+                channel_id,
+                info or "",
+                new_info,
+                get_key_index(old_entry),
+                get_key_index(entry),
+            ]
+
+        if not args:
+            return changed
+
+        updated, conflicts = await update_script(keys=keys, args=args)
+        changed += updated
+        updates = {channel_id: updates[channel_id] for channel_id in conflicts}
+
+    if updates:
+        logging.warning(f"{len(updates)} users of {index_key} changed concurrently")
+    return changed
+
+
+async def apply_alarm_tasks(
+    redis: Redis, tasks: Iterable[tuple[str, AlarmTaskInfo]]
+) -> int:
+    """Atomically applies net effect of (version, alarm task) tasks of every
+    user, two round trips per channel. Version is stream entry id of task,
+    so reclaimed tasks don't override newer ones, empty version isn't checked.
+    Returns number of changed users."""
+    changes: dict[Channel, dict[int, AlarmChange]] = defaultdict(dict)
+    for version, info in sorted(tasks, key=lambda task: get_entry_version(task[0])):
+        change = changes[info.channel].setdefault(info.channel_id, AlarmChange())
+        change.apply(info, version)
+
+    now = datetime.now(timezone.utc)
+    changed = 0
+    for channel, users in changes.items():
+        changed += await update_alarms(
+            redis,
+            channel,
+            {
+                str(channel_id): partial(change.get_entry, date=now)
+                for channel_id, change in users.items()
+            },
+        )
+
+    return changed
+
+
+async def set_users_alarms(
+    redis: Redis,
+    alarms: Iterable[tuple[Channel, int, str, str | None]],
+    version: str = "",
+):
+    """Adds (channel, channel_id, alarm, timezone) users to alarm buckets with
+    one command per bucket. Users mustn't be in alarm index yet, e.g. after
+    alarm keys were cleaned, since their old buckets aren't checked."""
+    now = datetime.now(timezone.utc)
+    # alarm, timezone: bucket, most users share few alarm times
+    buckets_cache: dict[tuple[str, str | None], str] = {}
+    buckets: dict[tuple[Channel, str], list[int]] = defaultdict(list)
+    # redis stubs expect str | bytes keys
+    index: dict[Channel, dict[str | bytes, str]] = defaultdict(dict)
+    for channel, channel_id, alarm, timezone_name in alarms:
+        bucket = buckets_cache.get((alarm, timezone_name))
+        if bucket is None:
+            bucket = get_alarm_bucket(alarm, timezone_name, now)
+            buckets_cache[(alarm, timezone_name)] = bucket
+
+        buckets[(channel, bucket)].append(channel_id)
+        index[channel][str(channel_id)] = AlarmIndexEntry(
+            bucket, alarm, timezone_name, version
+        ).to_str()
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for (channel, bucket), channel_ids in buckets.items():
+            pipe.sadd(rk.alarms_users(channel, bucket), *channel_ids)
+        for channel, entries in index.items():
+            pipe.hset(rk.alarms_index(channel), mapping=entries)
+        await pipe.execute()
+
+
+def _sync_entry(
+    entry: AlarmIndexEntry | None,
+    alarm: str,
+    timezone_name: str | None,
+    version: str,
+    date: datetime,
+) -> AlarmIndexEntry | None:
+    if entry and (
+        get_entry_version(entry.version) > get_entry_version(version)
+        or (entry.alarm == alarm and entry.timezone == timezone_name)
+    ):
+        return entry
+    bucket = get_alarm_bucket(alarm, timezone_name, date)
+    return AlarmIndexEntry(bucket, alarm, timezone_name, version)
+
+
+async def sync_users_alarms(
+    redis: Redis,
+    alarms: Iterable[tuple[Channel, int, str, str | None]],
+    version: str = "",
+) -> int:
+    """Moves (channel, channel_id, alarm, timezone) users, whose alarm index
+    entries differ, to buckets of their alarms. `version` is index version at
+    the start of sync, entries changed by newer tasks are kept.
+    Returns number of moved users."""
+    updates: dict[Channel, dict[str, AlarmUpdate]] = defaultdict(dict)
+    now = datetime.now(timezone.utc)
+    for channel, channel_id, alarm, timezone_name in alarms:
+        updates[channel][str(channel_id)] = partial(
+            _sync_entry,
+            alarm=alarm,
+            timezone_name=timezone_name,
+            version=version,
+            date=now,
+        )
+
+    moved = 0
+    for channel, channel_updates in updates.items():
+        moved += await update_alarms(redis, channel, channel_updates)
+    return moved
+
+
+def _remove_entry(
+    entry: AlarmIndexEntry | None, version: str
+) -> AlarmIndexEntry | None:
+    if not entry or is_removed_entry(entry):
+        return entry
+    if get_entry_version(entry.version) > get_entry_version(version):
+        return entry
+    return get_removed_entry(version)
+
+
+async def remove_missing_alarms(
+    redis: Redis,
+    channel: Channel,
+    channel_ids: set[int],
+    version: str = "",
+    batch_size: int = 1000,
+) -> int:
+    """Removes users, which aren't in `channel_ids`, from alarm index.
+    `version` is index version at the start of sync, entries changed by newer
+    tasks are kept. Returns number of removed users."""
+    removed = 0
+    update = partial(_remove_entry, version=version)
+    updates: dict[str, AlarmUpdate] = {}
+    async for channel_id, info in redis.hscan_iter(rk.alarms_index(channel)):
+        if int(channel_id) in channel_ids:
+            continue
+
+        updates[channel_id] = update
+        if len(updates) >= batch_size:
+            removed += await update_alarms(redis, channel, updates)
+            updates = {}
+
+    removed += await update_alarms(redis, channel, updates)
+    return removed
+
+
+def _rebucket_entry(
+    entry: AlarmIndexEntry | None, date: datetime, removed_before: str
+) -> AlarmIndexEntry | None:
+    if not entry:
+        return entry
+    if is_removed_entry(entry):
+        if get_entry_version(entry.version) < get_entry_version(removed_before):
+            return None
+        return entry
+    if not entry.timezone:
+        return entry
+    return entry._replace(bucket=get_alarm_bucket(entry.alarm, entry.timezone, date))
+
+
+async def rebucket_alarms(
+    redis: Redis, channel: Channel, removed_before: str = "", batch_size: int = 1000
+) -> int:
+    """Moves users with named timezones to buckets of their next alarms.
+    Users, whose alarm was changed meanwhile, are moved by their new alarm.
+    Entries of removed alarms older than `removed_before` version are dropped,
+    tasks older than that can't be reclaimed anymore.
+    Returns number of moved and dropped users."""
+    moved = 0
+    now = datetime.now(timezone.utc)
+    update = partial(_rebucket_entry, date=now, removed_before=removed_before)
+    updates: dict[str, AlarmUpdate] = {}
+    async for channel_id, info in redis.hscan_iter(rk.alarms_index(channel)):
+        entry = AlarmIndexEntry.from_str(info)
+        if not entry or update(entry) == entry:
+            continue
+
+        updates[channel_id] = update
+        if len(updates) >= batch_size:
+            moved += await update_alarms(redis, channel, updates)
+            updates = {}
+
+    moved += await update_alarms(redis, channel, updates)
+    return moved
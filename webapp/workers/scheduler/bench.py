@@ -0,0 +1,236 @@
+"""Scheduler load benchmark.
+
+Jobs are fired by virtual clock against in-process redis stand-in (fakeredis),
+so days of scheduler work are simulated in seconds. Scheduler's sleeps are
+skipped, but wall time of its work flows into virtual clock, so slow ticks
+and inexact sleeps show up as fire lag.
+"""
+
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone, tzinfo
+
+from common.constants import TIME_FMT, Channel
+from webapp.core.redis import AlarmActions, AlarmTaskInfo
+from webapp.core.settings import RedisSettings, SchedulerSettings
+from webapp.workers.scheduler.job_stores import IJobStore, MemoryJobStore, RedisJobStore
+from webapp.workers.scheduler.jobs import scheduler_task
+from webapp.workers.scheduler.scheduler import Scheduler
+from webapp.workers.scheduler.worker import ALARMS_TASKS_BATCH, handle_alarm_tasks
+
+JOBS_INTERVALS = [timedelta(hours=1), timedelta(days=1), timedelta(days=7)]
+ALARMS_TIMEZONES = [None, "Europe/Moscow", "Europe/London", "America/New_York"]
+
+BenchReport = dict[str, float]
+
+
+class VirtualClock:
+    """Clock for Scheduler, which goes with wall time while scheduler works
+    and jumps over its sleeps"""
+
+    def __init__(self, start: datetime) -> None:
+        self._start = start
+        self._slept = 0.0
+        self._started_at = time.perf_counter()
+
+    def __call__(self, tz: tzinfo | None = None) -> datetime:
+        now = self._start + timedelta(
+            seconds=time.perf_counter() - self._started_at + self._slept
+        )
+        if tz is None:
+            return now.astimezone().replace(tzinfo=None)
+        return now.astimezone(tz)
+
+    def sleep(self, seconds: float):
+        self._slept += seconds
+
+
+class RedisStats:
+
+    def __init__(self) -> None:
+        self.commands = 0
+        self.round_trips = 0
+
+
+def get_counting_redis(stats: RedisStats, decode_responses: bool):
+    """Returns fakeredis client, which counts sent commands. Responses are
+    decoded the same way as by client of benchmarked code in production."""
+    try:
+        from fakeredis import FakeAsyncRedis
+    except ImportError as ex:
+        raise RuntimeError(
+            "Benchmark needs fakeredis: pip install 'fakeredis[lua]'"
+        ) from ex
+
+    class CountingRedis(FakeAsyncRedis):
+
+        async def execute_command(self, *args, **options):
+            stats.commands += 1
+            stats.round_trips += 1
+            return await super().execute_command(*args, **options)
+
+        def pipeline(self, transaction=True, shard_hint=None):
+            pipe = super().pipeline(transaction, shard_hint)
+            execute = pipe.execute
+
+            async def counting_execute(raise_on_error: bool = True):
+                stats.commands += len(pipe.command_stack)
+                stats.round_trips += 1
+                return await execute(raise_on_error)
+
+            pipe.execute = counting_execute  # type: ignore[method-assign]
+            return pipe
+
+    return CountingRedis(decode_responses=decode_responses)
+
+
+class _FireLags:
+    clock: VirtualClock | None = None
+    lags: list[float] = []
+
+
+@scheduler_task(pass_fire_time=True)
+async def bench_task(fire_time: datetime):
+    if _FireLags.clock:
+        lag = _FireLags.clock(timezone.utc) - fire_time
+        _FireLags.lags.append(lag.total_seconds())
+
+
+def percentiles(values: list[float], name: str, scale: float = 1) -> BenchReport:
+    if not values:
+        return {}
+
+    ordered = sorted(values)
+    report = {}
+    for q in (50, 90, 99):
+        report[f"{name} p{q}"] = ordered[len(ordered) * q // 100] * scale
+    report[f"{name} max"] = ordered[-1] * scale
+    return report
+
+
+async def bench_scheduler(
+    jobs: int, days: float, memory_store: bool = False, seed: int = 0
+) -> BenchReport:
+    rnd = random.Random(seed)
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc))
+    stats = RedisStats()
+    job_store: IJobStore = (
+        MemoryJobStore()
+        if memory_store
+        else RedisJobStore(
+            # job store's own client doesn't decode responses
+            RedisSettings(),
+            client=get_counting_redis(stats, decode_responses=False),
+        )
+    )
+    scheduler = Scheduler(
+        job_store,
+        SchedulerSettings(max_running_jobs=jobs + 1, task_limits={}),
+        clock=clock,
+    )
+    scheduler.set_timezone(timezone.utc)
+
+    for job_num in range(jobs):
+        interval = rnd.choice(JOBS_INTERVALS)
+        # real jobs start at the beginning of minute
+        start_minute = rnd.randrange(int(interval.total_seconds() // 60))
+        await scheduler.add_job(
+            bench_task,
+            start_date=clock(timezone.utc) + timedelta(minutes=start_minute),
+            interval=interval,
+            job_id=f"bench:{job_num}",
+        )
+
+    _FireLags.clock, _FireLags.lags = clock, []
+    stats.commands = stats.round_trips = 0
+    end_ts = (clock(timezone.utc) + timedelta(days=days)).timestamp()
+    ticks: list[float] = []
+    bench_start = time.perf_counter()
+    # the same ticks as scheduler's jobs loop, but sleeps are virtual, jobs
+    # aren't changed meanwhile, so sleeps aren't interrupted
+    while clock(timezone.utc).timestamp() < end_ts:
+        tick_start = time.perf_counter()
+        sleep_time = await scheduler.tick()
+        while scheduler.metrics.pending or scheduler.metrics.running:
+            await asyncio.sleep(0)
+
+        ticks.append(time.perf_counter() - tick_start)
+        clock.sleep(sleep_time)
+
+    fired = len(_FireLags.lags)
+    _FireLags.clock = None
+    return {
+        "fired jobs": fired,
+        "ticks": len(ticks),
+        "wall time, s": time.perf_counter() - bench_start,
+        **percentiles(ticks, "tick, ms", 1000),
+        **percentiles(_FireLags.lags, "fire lag, ms", 1000),
+        "redis commands per job": stats.commands / fired if fired else 0,
+        "redis round trips per job": stats.round_trips / fired if fired else 0,
+    }
+
+
+async def bench_alarms(users: int, seed: int = 0) -> BenchReport:
+    """Measures alarm index updates made on alarms:queue tasks"""
+    rnd = random.Random(seed)
+    stats = RedisStats()
+    # redis_helper connections decode responses
+    redis = get_counting_redis(stats, decode_responses=True)
+
+    def add_task(channel_id: int) -> AlarmTaskInfo:
+        minutes = rnd.randrange(24 * 60)
+        alarm = (datetime.min + timedelta(minutes=minutes)).strftime(TIME_FMT)
+        return AlarmTaskInfo(
+            AlarmActions.add,
+            Channel.telegram,
+            channel_id,
+            alarm,
+            rnd.choice(ALARMS_TIMEZONES),
+        )
+
+    # every user sets alarm, then third of them changes it and third removes it
+    tasks = [add_task(channel_id) for channel_id in range(users)]
+    for channel_id in rnd.sample(range(users), 2 * users // 3):
+        task = add_task(channel_id)
+        if rnd.random() < 0.5:
+            task = tasks[channel_id]._replace(action=AlarmActions.delete)
+        tasks.append(task)
+
+    # ids of stream entries
+    entries = [(f"{num}-0", task.to_str()) for num, task in enumerate(tasks, 1)]
+    latencies = []
+    bench_start = time.perf_counter()
+    for entry in entries:
+        task_start = time.perf_counter()
+        await handle_alarm_tasks([entry], redis)
+        latencies.append(time.perf_counter() - task_start)
+
+    report = {
+        "alarm tasks": len(tasks),
+        "wall time, s": time.perf_counter() - bench_start,
+        **percentiles(latencies, "task, ms", 1000),
+        "redis commands per task": stats.commands / len(tasks) if tasks else 0,
+        "redis round trips per task": stats.round_trips / len(tasks) if tasks else 0,
+    }
+
+    # the same tasks drained from queue in batches
+    await redis.flushdb()
+    stats.commands = stats.round_trips = 0
+    bench_start = time.perf_counter()
+    for batch_start in range(0, len(entries), ALARMS_TASKS_BATCH):
+        await handle_alarm_tasks(
+            entries[batch_start : batch_start + ALARMS_TASKS_BATCH], redis
+        )
+
+    report["batched wall time, s"] = time.perf_counter() - bench_start
+    report["batched round trips per task"] = (
+        stats.round_trips / len(tasks) if tasks else 0
+    )
+    return report
+
+
+def format_report(name: str, report: BenchReport) -> str:
+    lines = [name]
+    lines += [f"  {key:<28}{value:>12.3f}" for key, value in report.items()]
+    return "\n".join(lines)
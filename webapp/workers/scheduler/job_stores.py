@@ -0,0 +1,374 @@
+import asyncio
+import heapq
+import logging
+from abc import ABC, abstractmethod
+from contextlib import suppress
+from datetime import datetime
+
+import redis.asyncio as redis
+
+from webapp.core.redis import RedisKeys
+from webapp.core.settings import RedisSettings
+from webapp.workers.scheduler.jobs import Job
+
+logger = logging.getLogger("Scheduler")
+
+# Atomically pops due jobs and moves them to the next fire time, so every
+# occurrence is claimed by exactly one of the running schedulers.
+# Next fire time is computed the same way as in FireCondition.get_next_fire_time,
+# but strictly after current time. One time jobs and ids without job data
+# are removed.
+# KEYS: runtimes zset, intervals hash, jobs hash
+# ARGV: current timestamp, max jobs to claim
+# Returns flat list of claimed job ids, their missed fire timestamps and
+# encoded jobs, empty for ids without job data, followed by the nearest
+# fire timestamp after claim, empty if there are no jobs.
+CLAIM_JOBS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local due = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', now, 'WITHSCORES', 'LIMIT', 0, ARGV[2]
+)
+local claimed = {}
+for i = 1, #due, 2 do
+    local job_id = due[i]
+    local job = redis.call('HGET', KEYS[3], job_id)
+    local interval = tonumber(redis.call('HGET', KEYS[2], job_id))
+    if job and interval and interval > 0 then
+        local fire_time = tonumber(due[i + 1])
+        local next_time = fire_time + interval * (math.floor((now - fire_time) / interval) + 1)
+        redis.call('ZADD', KEYS[1], next_time, job_id)
+    else
+        redis.call('ZREM', KEYS[1], job_id)
+        redis.call('HDEL', KEYS[2], job_id)
+        redis.call('HDEL', KEYS[3], job_id)
+    end
+    table.insert(claimed, job_id)
+    table.insert(claimed, due[i + 1])
+    table.insert(claimed, job or '')
+end
+local next_run = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+table.insert(claimed, next_run[2] or '')
+return claimed
+"""
+
+
+def get_next_timestamp(fire_ts: float, interval: float, now_ts: float) -> float:
+    """Next fire time strictly after `now_ts`, same as in CLAIM_JOBS_SCRIPT"""
+    return fire_ts + interval * ((now_ts - fire_ts) // interval + 1)
+
+
+class IJobStore(ABC):
+    """Storage of scheduled jobs, which may be shared by several schedulers."""
+
+    def __init__(self) -> None:
+        # set on every jobs change, so scheduler can wake up earlier
+        self.jobs_changed = asyncio.Event()
+        # nearest fire timestamp after the last claim, valid until jobs change
+        self.next_run_time: float | None = None
+
+    async def start(self): ...
+
+    async def shutdown(self): ...
+
+    @abstractmethod
+    async def add_job(self, job: Job, run_time: datetime): ...
+
+    @abstractmethod
+    async def get_job(self, job_id: str) -> Job | None: ...
+
+    @abstractmethod
+    async def replace_job(self, job: Job) -> bool:
+        """Replaces stored job with the same id, job keeps its next fire time.
+        Returns False, if job isn't stored."""
+
+    @abstractmethod
+    async def remove_job(self, job_id: str) -> bool: ...
+
+    @abstractmethod
+    async def claim_due_jobs(
+        self, date: datetime, limit: int
+    ) -> list[tuple[Job, datetime]]:
+        """Claims due jobs and moves interval jobs to their next fire time,
+        updates `next_run_time`. Returns jobs with their earliest missed
+        fire time."""
+
+    @abstractmethod
+    async def get_next_run_time(self) -> float | None:
+        """Returns timestamp of the nearest fire time"""
+
+    @abstractmethod
+    async def heartbeat(
+        self, instance_id: str, date: datetime, metrics: dict[str, int], ttl: int
+    ): ...
+
+    @abstractmethod
+    async def get_instances(self, expired_at: datetime) -> list[str]:
+        """Returns ids of schedulers, which sent heartbeat after `expired_at`"""
+
+    @abstractmethod
+    async def remove_instance(self, instance_id: str): ...
+
+
+class RedisJobStore(IJobStore):
+    """Durable job store shared by schedulers through redis."""
+
+    __jobs_key = RedisKeys.scheduler_jobs
+    __jobs_runtimes = RedisKeys.scheduler_runtimes
+    __jobs_intervals = RedisKeys.scheduler_intervals
+    __instances_key = RedisKeys.scheduler_instances
+    __wakeup_channel = RedisKeys.scheduler_wakeup
+    __jobs_cache_size: int = 10_000
+    __listen_timeout: float = 60
+
+    def __init__(
+        self, redis_settings: RedisSettings, client: redis.Redis | None = None
+    ):
+        super().__init__()
+        self.redis = client or redis.Redis(
+            host=redis_settings.host, port=redis_settings.port, db=redis_settings.db
+        )
+        # job_id: (encoded job, decoded job)
+        self._jobs_cache: dict[str, tuple[bytes, Job]] = {}
+        self._claim_jobs = self.redis.register_script(CLAIM_JOBS_SCRIPT)
+        self._listener_task: asyncio.Task | None = None
+
+    async def start(self):
+        self._listener_task = asyncio.create_task(self._listen_wakeups())
+
+    async def shutdown(self):
+        if self._listener_task:
+            self._listener_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._listener_task
+
+    async def add_job(self, job: Job, run_time: datetime):
+        interval = job.fire_cond.interval
+        async with self.redis.pipeline() as pipe:
+            pipe.multi()
+            pipe.hset(self.__jobs_key, job.id, job.to_json())
+            if interval:
+                pipe.hset(self.__jobs_intervals, job.id, interval.total_seconds())
+            else:
+                pipe.hdel(self.__jobs_intervals, job.id)
+            pipe.zadd(self.__jobs_runtimes, {job.id: run_time.timestamp()})
+            pipe.publish(self.__wakeup_channel, job.id)
+            await pipe.execute()
+
+    async def get_job(self, job_id: str) -> Job | None:
+        job_data = await self.redis.hget(self.__jobs_key, job_id)
+        return self._decode_job(job_id, job_data) if job_data else None
+
+    async def replace_job(self, job: Job) -> bool:
+        if await self.redis.zscore(self.__jobs_runtimes, job.id) is None:
+            return False
+
+        interval = job.fire_cond.interval
+        async with self.redis.pipeline() as pipe:
+            pipe.multi()
+            pipe.hset(self.__jobs_key, job.id, job.to_json())
+            if interval:
+                pipe.hset(self.__jobs_intervals, job.id, interval.total_seconds())
+            else:
+                pipe.hdel(self.__jobs_intervals, job.id)
+            pipe.publish(self.__wakeup_channel, job.id)
+            await pipe.execute()
+        return True
+
+    async def remove_job(self, job_id: str) -> bool:
+        if not await self.redis.hexists(self.__jobs_key, job_id):
+            return False
+
+        async with self.redis.pipeline() as pipe:
+            pipe.multi()
+            pipe.hdel(self.__jobs_key, job_id)
+            pipe.hdel(self.__jobs_intervals, job_id)
+            pipe.zrem(self.__jobs_runtimes, job_id)
+            pipe.publish(self.__wakeup_channel, job_id)
+            await pipe.execute()
+
+        self._jobs_cache.pop(job_id, None)
+        return True
+
+    async def claim_due_jobs(
+        self, date: datetime, limit: int
+    ) -> list[tuple[Job, datetime]]:
+        claimed = await self._claim_jobs(
+            keys=[self.__jobs_runtimes, self.__jobs_intervals, self.__jobs_key],
+            args=[date.timestamp(), limit],
+        )
+
+        *claimed, next_ts = claimed
+        self.next_run_time = float(next_ts) if next_ts else None
+        jobs = []
+        for job_id, fire_ts, job_data in zip(
+            claimed[::3], claimed[1::3], claimed[2::3]
+        ):
+            job_id = job_id.decode()
+            if not job_data:
+                logger.error(f"No job data was found for job {job_id!r}")
+                continue
+
+            job_obj = self._decode_job(job_id, job_data)
+            if not job_obj:
+                await self.remove_job(job_id)
+                continue
+
+            if not job_obj.fire_cond.interval:
+                # claimed one time job won't fire again
+                self._jobs_cache.pop(job_id, None)
+
+            jobs.append((job_obj, datetime.fromtimestamp(float(fire_ts), date.tzinfo)))
+
+        return jobs
+
+    async def get_next_run_time(self) -> float | None:
+        next_run = await self.redis.zrange(self.__jobs_runtimes, 0, 0, withscores=True)
+        return next_run[0][1] if next_run else None
+
+    async def heartbeat(
+        self, instance_id: str, date: datetime, metrics: dict[str, int], ttl: int
+    ):
+        metrics_key = RedisKeys.scheduler_metrics(instance_id)
+        async with self.redis.pipeline() as pipe:
+            pipe.zadd(self.__instances_key, {instance_id: date.timestamp()})
+            # redis stubs expect str | bytes keys
+            pipe.hset(metrics_key, mapping=dict(metrics.items()))
+            pipe.expire(metrics_key, ttl)
+            await pipe.execute()
+
+    async def get_instances(self, expired_at: datetime) -> list[str]:
+        await self.redis.zremrangebyscore(
+            self.__instances_key, 0, expired_at.timestamp()
+        )
+        return [
+            inst.decode() for inst in await self.redis.zrange(self.__instances_key, 0, -1)
+        ]
+
+    async def remove_instance(self, instance_id: str):
+        await self.redis.zrem(self.__instances_key, instance_id)
+
+    def _decode_job(self, job_id: str, job_data: bytes) -> Job | None:
+        cached = self._jobs_cache.get(job_id)
+        if cached and cached[0] == job_data:
+            return cached[1]
+
+        try:
+            job = Job.from_json(job_data)
+        except (ValueError, KeyError, TypeError) as ex:
+            logger.error(f"Can't decode job {job_id!r}: {ex}")
+            return None
+
+        if len(self._jobs_cache) >= self.__jobs_cache_size:
+            # drop the oldest cached job
+            self._jobs_cache.pop(next(iter(self._jobs_cache)))
+        self._jobs_cache[job_id] = (job_data, job)
+        return job
+
+    async def _listen_wakeups(self):
+        """Notifies about jobs changes made by any scheduler"""
+        async with self.redis.pubsub() as pubsub:
+            await pubsub.subscribe(self.__wakeup_channel)
+            while True:
+                try:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=self.__listen_timeout
+                    )
+                except redis.ConnectionError as ex:
+                    logger.error(f"Lost wakeups subscription: {ex}")
+                    await asyncio.sleep(1)
+                    continue
+
+                if message:
+                    self.jobs_changed.set()
+
+
+class MemoryJobStore(IJobStore):
+    """Not durable in-process job store for single scheduler deployments,
+    tests and benchmarks. Jobs are kept in a heap ordered by fire time."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        # job_id: (job, fire timestamp)
+        self._jobs: dict[str, tuple[Job, float]] = {}
+        # (fire timestamp, sequence number, job_id), outdated entries are
+        # skipped on pop instead of removing them from heap
+        self._heap: list[tuple[float, int, str]] = []
+        self._seq = 0
+        self._instances: dict[str, float] = {}
+        self.metrics: dict[str, dict[str, int]] = {}
+
+    def _schedule(self, job: Job, timestamp: float):
+        self._jobs[job.id] = (job, timestamp)
+        self._seq += 1
+        heapq.heappush(self._heap, (timestamp, self._seq, job.id))
+
+    def _drop_outdated(self):
+        while self._heap:
+            timestamp, _, job_id = self._heap[0]
+            stored = self._jobs.get(job_id)
+            if stored and stored[1] == timestamp:
+                return
+            heapq.heappop(self._heap)
+
+    async def add_job(self, job: Job, run_time: datetime):
+        self._schedule(job, run_time.timestamp())
+        self.jobs_changed.set()
+
+    async def get_job(self, job_id: str) -> Job | None:
+        stored = self._jobs.get(job_id)
+        return stored[0] if stored else None
+
+    async def replace_job(self, job: Job) -> bool:
+        if not (stored := self._jobs.get(job.id)):
+            return False
+
+        # heap entry stays valid, fire timestamp isn't changed
+        self._jobs[job.id] = (job, stored[1])
+        self.jobs_changed.set()
+        return True
+
+    async def remove_job(self, job_id: str) -> bool:
+        if not self._jobs.pop(job_id, None):
+            return False
+
+        self.jobs_changed.set()
+        return True
+
+    async def claim_due_jobs(
+        self, date: datetime, limit: int
+    ) -> list[tuple[Job, datetime]]:
+        now_ts = date.timestamp()
+        jobs: list[tuple[Job, datetime]] = []
+        self._drop_outdated()
+        while self._heap and self._heap[0][0] <= now_ts and len(jobs) < limit:
+            fire_ts, _, job_id = heapq.heappop(self._heap)
+            job, _ = self._jobs[job_id]
+            if interval := job.fire_cond.interval:
+                next_ts = get_next_timestamp(fire_ts, interval.total_seconds(), now_ts)
+                self._schedule(job, next_ts)
+            else:
+                del self._jobs[job_id]
+
+            jobs.append((job, datetime.fromtimestamp(fire_ts, date.tzinfo)))
+            self._drop_outdated()
+
+        self.next_run_time = self._heap[0][0] if self._heap else None
+        return jobs
+
+    async def get_next_run_time(self) -> float | None:
+        self._drop_outdated()
+        return self._heap[0][0] if self._heap else None
+
+    async def heartbeat(
+        self, instance_id: str, date: datetime, metrics: dict[str, int], ttl: int
+    ):
+        self._instances[instance_id] = date.timestamp()
+        self.metrics[instance_id] = metrics
+
+    async def get_instances(self, expired_at: datetime) -> list[str]:
+        expired_ts = expired_at.timestamp()
+        return [inst for inst, ts in self._instances.items() if ts > expired_ts]
+
+    async def remove_instance(self, instance_id: str):
+        self._instances.pop(instance_id, None)
+        self.metrics.pop(instance_id, None)
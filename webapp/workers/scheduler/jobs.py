@@ -0,0 +1,256 @@
+import json
+import math
+from datetime import datetime, timedelta, timezone, tzinfo
+from enum import StrEnum, auto
+from typing import Any, Callable, Coroutine
+from uuid import uuid4
+
+JOB_FORMAT_VERSION = 2
+
+TaskFunc = Callable[..., Coroutine]
+
+
+class TasksRegistry:
+    """Functions which can be run by scheduler. Jobs store only the name of
+    registered function, so stored data can't make scheduler call anything else."""
+
+    def __init__(self) -> None:
+        self._tasks: dict[str, TaskFunc] = {}
+        self._fire_time_receivers: set[str] = set()
+
+    def register(self, func: TaskFunc | None = None, *, pass_fire_time: bool = False):
+        """Registers task. With `pass_fire_time` task gets planned fire time
+        as `fire_time` keyword argument, e.g. to handle missed runs properly."""
+
+        def decorator(func: TaskFunc) -> TaskFunc:
+            name = func.__name__
+            if self._tasks.get(name, func) is not func:
+                raise ValueError(f"Another task was already registered as {name!r}")
+
+            self._tasks[name] = func
+            if pass_fire_time:
+                self._fire_time_receivers.add(name)
+            return func
+
+        return decorator(func) if func else decorator
+
+    def get(self, name: str) -> TaskFunc:
+        if name not in self._tasks:
+            raise ValueError(f"Task {name!r} isn't registered")
+        return self._tasks[name]
+
+    def name_of(self, func: TaskFunc) -> str:
+        if self._tasks.get(func.__name__) is not func:
+            raise ValueError(f"Task {func.__qualname__!r} isn't registered")
+        return func.__name__
+
+    def needs_fire_time(self, func: TaskFunc) -> bool:
+        return self.name_of(func) in self._fire_time_receivers
+
+
+tasks_registry = TasksRegistry()
+scheduler_task = tasks_registry.register
+
+
+class MisfirePolicy(StrEnum):
+    """What to do with fire times missed while scheduler was down or busy"""
+
+    coalesce = auto()  # run once for the latest missed fire time
+    run_all = auto()  # run every missed fire time, but no more than max_runs
+    skip = auto()  # run like coalesce, unless it's later than grace time
+
+
+class Misfire:
+
+    def __init__(
+        self,
+        policy: MisfirePolicy = MisfirePolicy.coalesce,
+        *,
+        grace: timedelta | None = None,
+        max_runs: int = 1,
+    ) -> None:
+        self.policy = policy
+        self.grace = grace
+        self.max_runs = max_runs
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "grace": self.grace.total_seconds() if self.grace else None,
+            "max_runs": self.max_runs,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "Misfire":
+        grace = data["grace"]
+        return cls(
+            MisfirePolicy(data["policy"]),
+            grace=timedelta(seconds=grace) if grace is not None else None,
+            max_runs=data["max_runs"],
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Misfire(policy={self.policy}, "
+            f"grace={self.grace}, max_runs={self.max_runs})"
+        )
+
+    def get_run_times(
+        self, fire_time: datetime, interval: timedelta | None, date: datetime
+    ) -> list[datetime]:
+        """Returns fire times to run, when job was due since `fire_time`"""
+        missed = int((date - fire_time) / interval) + 1 if interval else 1
+        last_time = fire_time + interval * (missed - 1) if interval else fire_time
+
+        if self.policy == MisfirePolicy.run_all and interval:
+            runs = min(missed, self.max_runs)
+            return [last_time - interval * i for i in reversed(range(runs))]
+
+        if (
+            self.policy == MisfirePolicy.skip
+            and self.grace is not None
+            and date - last_time > self.grace
+        ):
+            return []
+
+        return [last_time]
+
+
+class FireCondition:
+
+    def __init__(
+        self,
+        start: datetime | None,
+        interval: timedelta | None,
+        *,
+        offset: tzinfo | None = None,
+    ) -> None:
+        self.offset = offset
+        self.start = start if start else datetime.now(self.offset)
+        self.interval = interval
+
+    def to_dict(self) -> dict[str, Any]:
+        offset = self.offset.utcoffset(self.start) if self.offset else None
+        return {
+            "start": self.start.isoformat(),
+            "interval": self.interval.total_seconds() if self.interval else None,
+            "offset": offset.total_seconds() if offset is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "FireCondition":
+        interval, offset = data["interval"], data["offset"]
+        return cls(
+            datetime.fromisoformat(data["start"]),
+            timedelta(seconds=interval) if interval is not None else None,
+            offset=timezone(timedelta(seconds=offset)) if offset is not None else None,
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"FireCond(start={self.start}, "
+            f"interval={self.interval}, offset={self.offset})"
+        )
+
+    def get_next_fire_time(self, date: datetime | None = None) -> datetime | None:
+        date = date or datetime.now(self.offset)
+        if self.start > date:
+            return self.start
+
+        if not self.interval:
+            return None
+
+        timediff = (date - self.start).total_seconds()
+        intervals_num = int(math.ceil(timediff / self.interval.total_seconds()))
+        return self.start + self.interval * intervals_num
+
+
+class Job:
+
+    def __init__(
+        self,
+        func,
+        args,
+        kwargs,
+        fire_condition: FireCondition,
+        job_id: str | None = None,
+        misfire: Misfire | None = None,
+        timeout: timedelta | None = None,
+    ):
+        self.id = job_id or str(uuid4())
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.fire_cond = fire_condition
+        self.misfire = misfire or Misfire()
+        self.timeout = timeout
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "v": JOB_FORMAT_VERSION,
+                "id": self.id,
+                "func": tasks_registry.name_of(self.func),
+                "args": self.args,
+                "kwargs": self.kwargs,
+                "fire_cond": self.fire_cond.to_dict(),
+                "misfire": self.misfire.to_dict(),
+                "timeout": self.timeout.total_seconds() if self.timeout else None,
+            },
+            separators=(",", ":"),
+        )
+
+    def get_definition(self) -> str:
+        """Encoded task, schedule and policies of job without its start date,
+        so periodic job can be compared with its stored version"""
+        return json.dumps(
+            {
+                "func": tasks_registry.name_of(self.func),
+                "args": self.args,
+                "kwargs": self.kwargs,
+                "interval": (
+                    self.fire_cond.interval.total_seconds()
+                    if self.fire_cond.interval
+                    else None
+                ),
+                "misfire": self.misfire.to_dict(),
+                "timeout": self.timeout.total_seconds() if self.timeout else None,
+            },
+            sort_keys=True,
+        )
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> "Job":
+        state = json.loads(data)
+        # v1 jobs have no misfire policy, default one is used
+        if state.get("v") not in (1, JOB_FORMAT_VERSION):
+            raise ValueError(f"Unsupported job format version: {state.get('v')}")
+
+        misfire, timeout = state.get("misfire"), state.get("timeout")
+        return cls(
+            tasks_registry.get(state["func"]),
+            state["args"],
+            state["kwargs"],
+            FireCondition.from_dict(state["fire_cond"]),
+            state["id"],
+            Misfire.from_dict(misfire) if misfire else None,
+            timedelta(seconds=timeout) if timeout else None,
+        )
+
+    def __repr__(self) -> str:
+        return f"Job(id={self.id}, func={self.func.__qualname__}, fire_cond={repr(self.fire_cond)})"
+
+    @property
+    def task_name(self) -> str:
+        return tasks_registry.name_of(self.func)
+
+    def get_coro(self, fire_time: datetime | None = None):
+        if fire_time and tasks_registry.needs_fire_time(self.func):
+            return self.func(*self.args, fire_time=fire_time, **self.kwargs)
+        return self.func(*self.args, **self.kwargs)
+
+    def get_run_times(self, fire_time: datetime, date: datetime) -> list[datetime]:
+        return self.misfire.get_run_times(fire_time, self.fire_cond.interval, date)
+
+    def get_next_fire_time(self, date: datetime | None = None) -> datetime | None:
+        return self.fire_cond.get_next_fire_time(date)
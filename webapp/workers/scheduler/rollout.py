@@ -0,0 +1,144 @@
+"""Weekly reports rollout.
+
+Reports aren't ordered at once, but spread over the rollout window, so report
+workers and bots get steady load. Every user has stable minute slot in window,
+reports wait in delayed set until their slot comes and then are moved to
+reports queue. Slots are only even on average, so no more than rate reports
+are moved per minute, the rest of crowded slot waits for the next minutes.
+"""
+
+import math
+import zlib
+from datetime import datetime
+
+import redis.asyncio as aredis
+
+from webapp.core.redis import RedisKeys as rk
+from webapp.core.redis import enqueue_tasks
+from webapp.core.settings import settings
+
+RELEASE_REPORTS_BATCH = 1000
+
+# Moves reports, which slot has come, from delayed set to reports stream
+# and counts them in rollout progress. Reports moved in current minute are
+# counted too, so no more than rate reports are moved per minute.
+# KEYS: delayed zset, reports stream, rollout hash
+# ARGV: current timestamp, max reports to move, stream max length,
+# max reports per minute, 0 for no limit
+# Returns number of moved reports
+RELEASE_REPORTS_SCRIPT = """
+local limit = tonumber(ARGV[2])
+local rate = tonumber(ARGV[4])
+if rate > 0 then
+    local minute = math.floor(tonumber(ARGV[1]) / 60)
+    if tonumber(redis.call('HGET', KEYS[3], 'minute') or -1) ~= minute then
+        redis.call('HSET', KEYS[3], 'minute', minute, 'minute_released', 0)
+    end
+    local minute_released = tonumber(redis.call('HGET', KEYS[3], 'minute_released'))
+    limit = math.min(limit, rate - minute_released)
+    if limit <= 0 then
+        return 0
+    end
+end
+local tasks = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, limit)
+if #tasks == 0 then
+    return 0
+end
+for _, task in ipairs(tasks) do
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'task', task)
+end
+redis.call('ZREM', KEYS[1], unpack(tasks))
+redis.call('HINCRBY', KEYS[3], 'released', #tasks)
+redis.call('HINCRBY', KEYS[3], 'minute_released', #tasks)
+return #tasks
+"""
+
+
+def get_rollout_window(total: int, window: int, rate: int) -> int:
+    """Minutes to order `total` reports in, window is extended so reports
+    are ordered no faster than `rate` per minute. Zero means at once."""
+    if window <= 0:
+        return 0
+    if rate > 0:
+        window = max(window, math.ceil(total / rate))
+    return window
+
+
+def get_report_slot(user_id: int, window: int) -> int:
+    """Minute of window for user's report. Slot is stable, so user gets
+    report at about the same time every week."""
+    return zlib.crc32(str(user_id).encode()) % window if window > 0 else 0
+
+
+async def start_rollout(
+    redis: aredis.Redis, start: datetime, window: int, total: int
+):
+    """Resets rollout progress, reports of previous rollout aren't counted"""
+    start_ts = int(start.timestamp())
+    await redis.hset(
+        rk.reports_rollout,
+        mapping={
+            "start": start_ts,
+            "end": start_ts + window * 60,
+            "total": total,
+            "released": 0,
+        },
+    )
+
+
+async def delay_reports(
+    redis: aredis.Redis, start: datetime, window: int, tasks: list[tuple[int, str]]
+):
+    """Puts (user_id, report task) to delayed set, scored by user's slot time.
+    Without window reports are ordered right away."""
+    if not tasks:
+        return
+
+    if window <= 0:
+        await enqueue_tasks(
+            redis,
+            rk.reports_queue,
+            [task for _, task in tasks],
+            settings.queues.max_len,
+        )
+        await redis.hincrby(rk.reports_rollout, "released", len(tasks))
+        return
+
+    start_ts = int(start.timestamp())
+    await redis.zadd(
+        rk.reports_delayed,
+        {
+            task: start_ts + get_report_slot(user_id, window) * 60
+            for user_id, task in tasks
+        },
+    )
+
+
+async def release_reports(
+    redis: aredis.Redis, now: datetime, rate: int, batch: int = RELEASE_REPORTS_BATCH
+) -> int:
+    """Orders reports, which slot has come, but no more than `rate` per minute,
+    0 for no limit. Returns number of ordered reports"""
+    release = redis.register_script(RELEASE_REPORTS_SCRIPT)
+    keys = [rk.reports_delayed, rk.reports_queue, rk.reports_rollout]
+    args = [now.timestamp(), batch, settings.queues.max_len, rate]
+    released = 0
+    while True:
+        moved = await release(keys=keys, args=args)
+        released += moved
+        if moved < batch:
+            return released
+
+
+async def get_rollout_progress(redis: aredis.Redis) -> dict[str, int]:
+    """Returns start and end timestamps, total and released reports of the
+    last rollout, reports released in the last minute and number of reports
+    still waiting for their slot or free rate"""
+    async with redis.pipeline() as pipe:
+        pipe.hgetall(rk.reports_rollout)
+        pipe.zcard(rk.reports_delayed)
+        rollout, delayed = await pipe.execute()
+
+    progress = {key: int(value) for key, value in rollout.items()}
+    progress["delayed"] = delayed
+    return progress
@@ -1,126 +1,88 @@
 import asyncio
 import logging
-import math
-import pickle
+import os
+import platform
+from collections import Counter, deque
 from datetime import datetime, timedelta, tzinfo
+from typing import Callable
 from uuid import uuid4
 
-import redis.asyncio as redis
-
-from webapp.core.redis import RedisKeys
-from webapp.core.settings import RedisSettings
+from webapp.core.settings import SchedulerSettings
+from webapp.workers.scheduler.job_stores import IJobStore
+from webapp.workers.scheduler.jobs import FireCondition, Job, Misfire, TaskFunc
 
 logger = logging.getLogger("Scheduler")
 
+Clock = Callable[[tzinfo | None], datetime]
 
-class FireCondition:
-
-    def __init__(
-        self,
-        start: datetime | None,
-        interval: timedelta | None,
-        *,
-        offset: tzinfo | None = None,
-    ) -> None:
-        self.offset = offset
-        self.start = start if start else datetime.now(self.offset)
-        self.interval = interval
-
-    def __getstate__(self) -> object:
-        return {
-            "start_date": self.start,
-            "interval": self.interval,
-            "offset": self.offset,
-        }
-
-    def __setstate__(self, state):
-        self.start = state["start_date"]
-        self.interval = state["interval"]
-        self.offset = state["offset"]
-
-    def __repr__(self) -> str:
-        return (
-            f"FireCond(start={self.start}, "
-            f"interval={self.interval}, offset={self.offset})"
-        )
-
-    def get_next_fire_time(self, date: datetime | None = None) -> datetime | None:
-        date = date or datetime.now(self.offset)
-        if self.start > date:
-            return self.start
-
-        if not self.interval:
-            return None
 
-        timediff = (date - self.start).total_seconds()
-        intervals_num = int(math.ceil(timediff / self.interval.total_seconds()))
-        return self.start + self.interval * intervals_num
+class SchedulerMetrics:
+    """Counters of scheduler instance jobs"""
 
+    def __init__(self) -> None:
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.skipped = 0
+        self.pending = 0
+        self.running = 0
 
-class Job:
-
-    def __init__(self, func, args, kwargs, fire_condition: FireCondition):
-        self.id = str(uuid4())
-        self.func = func
-        self.args = args
-        self.kwargs = kwargs
-        self.fire_cond = fire_condition
-
-    def __getstate__(self):
-        func_ref = self.func.__module__ + ":" + self.func.__qualname__
-        return {
-            "id": self.id,
-            "func": func_ref,
-            "args": self.args,
-            "kwargs": self.kwargs,
-            "fire_cond": self.fire_cond,
-        }
-
-    def __setstate__(self, state):
-        self.id = state["id"]
-        module, func_name = state["func"].split(":", 1)
-        module_obj = __import__(module, fromlist=[func_name])
-        self.func = getattr(module_obj, func_name)
-        self.args = state["args"]
-        self.kwargs = state["kwargs"]
-        self.fire_cond = state["fire_cond"]
-
-    def __repr__(self) -> str:
-        return f"Job(id={self.id}, func={self.func.__qualname__}, fire_cond={repr(self.fire_cond)})"
-
-    def get_coro(self):
-        return self.func(*self.args, **self.kwargs)
-
-    def get_next_fire_time(self, date: datetime | None = None) -> datetime | None:
-        return self.fire_cond.get_next_fire_time(date)
+    def to_dict(self) -> dict[str, int]:
+        return dict(vars(self))
 
 
 class Scheduler:
 
-    __jobs_key = RedisKeys.scheduler_jobs
-    __jobs_runtimes = RedisKeys.scheduler_runtimes
-    __delay: int = 1
+    __claim_batch: int = 1000
+    # upper bound for sleeping, so scheduler recovers even if wakeup was missed
+    __max_delay: float = 60
 
-    def __init__(self, redis_settings: RedisSettings):
-        self.redis = redis.Redis(
-            host=redis_settings.host, port=redis_settings.port, db=redis_settings.db
-        )
+    def __init__(
+        self,
+        job_store: IJobStore,
+        scheduler_settings: SchedulerSettings | None = None,
+        clock: Clock = datetime.now,
+    ):
+        self._job_store = job_store
+        self._settings = scheduler_settings or SchedulerSettings()
+        # replaced by virtual clock in benchmarks
+        self._clock = clock
         self._eventloop: asyncio.AbstractEventLoop = None  # type: ignore
         self._offset: tzinfo | None = None
         self._running_tasks: set[asyncio.Task] = set()
+        # task name: due jobs waiting for free slot
+        self._pending: dict[str, deque[tuple[Job, datetime]]] = {}
+        self._running_by_task: Counter[str] = Counter()
+        self.metrics = SchedulerMetrics()
         self._active = False
+        self._process_id = f"{platform.node()}-{os.getpid()}"
+        self.instance_id = f"{self._process_id}:{uuid4()}"
+        # timestamp, heartbeat is sent once per __max_delay
+        self._heartbeat_at = 0.0
 
     def set_timezone(self, offset: tzinfo):
         self._offset = offset
 
     async def add_job(
         self,
-        func: object,
+        func: TaskFunc,
         args: list | None = None,
         kwargs: dict | None = None,
         start_date: datetime | None = None,
         interval: timedelta | None = None,
+        job_id: str | None = None,
+        misfire: Misfire | None = None,
+        replace_existing: bool = True,
+        timeout: timedelta | None = None,
     ) -> Job:
+        """Adds job. Job with the same `job_id` is replaced, so fixed ids make
+        adding of periodic jobs safe for several running schedulers.
+        Without `replace_existing` already stored job keeps its schedule, so
+        fire times missed while scheduler was down are handled by its misfire
+        policy. Its task, arguments, interval and policies are still updated,
+        if they were changed.
+        """
         if args is None:
             args = []
 
@@ -130,102 +92,185 @@ class Scheduler:
         if start_date and start_date.tzinfo is None and self._offset is not None:
             start_date = start_date.replace(tzinfo=self._offset)
 
-        now = datetime.now(self._offset)
-        fire_cond = FireCondition(start_date, interval, offset=self._offset)
-        job = Job(func, args, kwargs, fire_cond)
-        async with self.redis.pipeline() as pipe:
-            pipe.multi()
-            pipe.hset(self.__jobs_key, job.id, pickle.dumps(job))
-            pipe.zadd(
-                self.__jobs_runtimes,
-                {job.id: (job.get_next_fire_time(now) or now).timestamp()},
-            )
-            await pipe.execute()
+        now = self._clock(self._offset)
+        fire_cond = FireCondition(start_date or now, interval, offset=self._offset)
+        job = Job(func, args, kwargs, fire_cond, job_id, misfire, timeout)
+
+        if job_id and not replace_existing:
+            if stored_job := await self._job_store.get_job(job_id):
+                if stored_job.get_definition() == job.get_definition():
+                    logger.info(f"Job {repr(stored_job)} already exists")
+                    return stored_job
+
+                if await self._job_store.replace_job(job):
+                    logger.info(f"Job {repr(stored_job)} was replaced by {repr(job)}")
+                    return job
+
+        await self._job_store.add_job(job, job.get_next_fire_time(now) or now)
 
         logger.info(f"New job {repr(job)} was added")
         return job
 
     async def remove_job(self, job: Job | str):
         job_id = job if isinstance(job, str) else job.id
-        if not await self.redis.hexists(self.__jobs_key, job_id):
+        if not await self._job_store.remove_job(job_id):
             return
 
-        async with self.redis.pipeline() as pipe:
-            pipe.multi()
-            pipe.hdel(self.__jobs_key, job_id)
-            pipe.zrem(self.__jobs_runtimes, job_id)
-            await pipe.execute()
-
         logger.info(f"Job {repr(job)} was removed")
 
     async def start(self):
         self._active = True
         self._eventloop = asyncio.get_running_loop()
+        await self._job_store.start()
         self._task = self._eventloop.create_task(self._process_jobs())
         logger.info("Starting scheduler")
 
     async def stop(self):
         self._active = False
+        self._job_store.jobs_changed.set()
         logger.info("Stopping scheduler")
 
     async def shutdown(self):
         self._active = False
-        await self._task
+        self._job_store.jobs_changed.set()
+        try:
+            await self._task
+        finally:
+            # otherwise instance counts as live until its heartbeat expires
+            await self._job_store.shutdown()
+            await self._job_store.remove_instance(self.instance_id)
         logger.info("Shutting down scheduler. Waiting for tasks to finish")
-        if self._running_tasks:
-            await asyncio.wait(self._running_tasks)
+        # pending jobs are started as running ones finish
+        while self._running_tasks:
+            await asyncio.wait(set(self._running_tasks))
+
+    async def heartbeat(self):
+        """Marks this scheduler instance as alive and publishes its metrics"""
+        self._heartbeat_at = self._clock(self._offset).timestamp()
+        await self._job_store.heartbeat(
+            self.instance_id,
+            self._clock(self._offset),
+            self.metrics.to_dict(),
+            int(3 * self.__max_delay),
+        )
 
-    async def _get_jobs(self, date: datetime) -> list[Job]:
-        jobs_ids = await self.redis.zrangebyscore(
-            self.__jobs_runtimes, 0, date.timestamp()
+    async def get_live_instances(self) -> list[str]:
+        """Returns ids of other schedulers, which sent heartbeat recently"""
+        # alive scheduler sends heartbeat at least once per __max_delay
+        expired_at = self._clock(self._offset) - timedelta(
+            seconds=3 * self.__max_delay
         )
-        if not jobs_ids:
-            return []
-
-        jobs = []
-        jobs_data = await self.redis.hmget(self.__jobs_key, jobs_ids)
-        for job_id, job_data in zip(jobs_ids, jobs_data):
-            if not job_data:
-                logger.error(f"No job data was found for job {job_id!r}")
-                await self.redis.zrem(self.__jobs_runtimes, job_id)
+        live_instances = []
+        for inst_id in await self._job_store.get_instances(expired_at):
+            if inst_id == self.instance_id:
                 continue
+            # the same process on the same host is dead predecessor of this one,
+            # e.g. in restarted container, which wasn't shut down cleanly
+            if inst_id.rpartition(":")[0] == self._process_id:
+                await self._job_store.remove_instance(inst_id)
+                continue
+            live_instances.append(inst_id)
+        return live_instances
+
+    def _run_job(self, job: Job, fire_time: datetime):
+        """Puts job to pending queue, it's started when limits allow"""
+        self._pending.setdefault(job.task_name, deque()).append((job, fire_time))
+        self.metrics.pending += 1
+        self._dispatch()
+
+    def _has_free_slot(self, task_name: str) -> bool:
+        task_limit = self._settings.task_limits.get(task_name)
+        return len(self._running_tasks) < self._settings.max_running_jobs and (
+            task_limit is None or self._running_by_task[task_name] < task_limit
+        )
 
-            job_obj = pickle.loads(job_data)
-            jobs.append(job_obj)
+    def _dispatch(self):
+        for task_name, queue in self._pending.items():
+            while queue and self._has_free_slot(task_name):
+                self.metrics.pending -= 1
+                self._start_job(*queue.popleft())
+
+    def _get_timeout(self, job: Job) -> float:
+        if job.timeout:
+            return job.timeout.total_seconds()
+        return self._settings.task_timeouts.get(job.task_name, self._settings.job_timeout)
+
+    def _start_job(self, job: Job, fire_time: datetime):
+        # job could wait in queue longer than its misfire policy allows
+        if not job.get_run_times(fire_time, self._clock(self._offset)):
+            logger.warning(f"Skipping {repr(job)} pending since {fire_time}")
+            self.metrics.skipped += 1
+            return
 
-        return jobs
+        task_name = job.task_name
 
-    def _run_job(self, job: Job):
         def callback(task: asyncio.Task):
             self._running_tasks.discard(task)
-            if ex := task.exception():
+            self._running_by_task[task_name] -= 1
+            self.metrics.running -= 1
+            ex = None if task.cancelled() else task.exception()
+            if isinstance(ex, TimeoutError):
+                self.metrics.timed_out += 1
+                logger.error(f"{repr(job)} was cancelled by timeout")
+            elif ex:
+                self.metrics.failed += 1
                 logger.error(
                     f"Unhandled exception occured while {repr(job)} was running: ",
                     exc_info=ex,
                 )
+            else:
+                self.metrics.succeeded += 1
+
+            self._dispatch()
 
-        task = self._eventloop.create_task(job.get_coro())
+        task = asyncio.create_task(
+            asyncio.wait_for(job.get_coro(fire_time), self._get_timeout(job))
+        )
         self._running_tasks.add(task)
+        self._running_by_task[task_name] += 1
+        self.metrics.started += 1
+        self.metrics.running += 1
         task.add_done_callback(callback)
 
-    async def _enqueue_job_repeat(self, jobs: list[Job], date: datetime):
-        async with self.redis.pipeline() as pipe:
-            pipe.multi()
-            for job in jobs:
-                next_time = job.get_next_fire_time(date)
-                if next_time:
-                    pipe.zadd(self.__jobs_runtimes, {job.id: next_time.timestamp()})
-                else:
-                    pipe.zrem(self.__jobs_runtimes, job.id)
-
-            await pipe.execute()
+    def _get_sleep_time(self) -> float:
+        # jobs changes wake scheduler up, so time known from claim is enough
+        next_timestamp = self._job_store.next_run_time
+        if next_timestamp is None:
+            return self.__max_delay
+
+        delay = next_timestamp - self._clock(self._offset).timestamp()
+        return min(max(delay, 0), self.__max_delay)
+
+    async def process_due_jobs(self) -> int:
+        """Claims due jobs and runs them. Returns number of claimed jobs"""
+        now = self._clock(self._offset)
+        jobs = await self._job_store.claim_due_jobs(now, self.__claim_batch)
+        for job, fire_time in jobs:
+            run_times = job.get_run_times(fire_time, now)
+            if not run_times:
+                logger.warning(f"Skipping {repr(job)} missed since {fire_time}")
+                self.metrics.skipped += 1
+
+            for run_time in run_times:
+                self._run_job(job, run_time)
+
+        return len(jobs)
+
+    async def tick(self) -> float:
+        """Sends heartbeat if it's time and runs due jobs. Returns seconds to
+        sleep until the next tick, unless jobs are changed meanwhile."""
+        # clear before reading jobs, so changes made meanwhile aren't missed
+        self._job_store.jobs_changed.clear()
+        now = self._clock(self._offset).timestamp()
+        if now - self._heartbeat_at >= self.__max_delay:
+            await self.heartbeat()
+        await self.process_due_jobs()
+        return self._get_sleep_time()
 
     async def _process_jobs(self):
         while self._active:
-            now = datetime.now(self._offset)
-            jobs = await self._get_jobs(now)
-            for job in jobs:
-                self._run_job(job)
-
-            await self._enqueue_job_repeat(jobs, now)
-            await asyncio.sleep(self.__delay)
+            sleep_time = await self.tick()
+            try:
+                await asyncio.wait_for(self._job_store.jobs_changed.wait(), sleep_time)
+            except TimeoutError:
+                pass
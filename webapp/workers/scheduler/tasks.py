@@ -1,129 +1,337 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Sequence
+from datetime import datetime, timedelta, timezone
 
-import httpx
 import redis.asyncio as aredis
-from sqlalchemy import delete, select
+from sqlalchemy import delete, func, select, text
 
-from common.constants import (
-    CERTS_DIR,
-    DAYS_TO_STORE_ENTRIES,
-    ENTRY_DATE_FORMAT,
-    Channel,
-)
-from common.utils import concat_url, gen_jwt_token
+from common.constants import DAYS_TO_STORE_ENTRIES, ENTRY_DATE_FORMAT, TIME_FMT, Channel
 from webapp.core import db_helper, redis_helper
 from webapp.core.models import JournalEntry, User
 from webapp.core.redis import RedisKeys as rk
 from webapp.core.redis import ReportRequester, ReportTaskInfo
+from webapp.core.settings import settings
+from webapp.workers.reports.report_cache import clear_reports_cache
+from webapp.workers.scheduler.alarms import get_index_version, rebucket_alarms
+from webapp.workers.scheduler.jobs import scheduler_task
+from webapp.workers.scheduler.rollout import (
+    delay_reports,
+    get_rollout_progress,
+    get_rollout_window,
+    release_reports,
+    start_rollout,
+)
+from webapp.workers.webhooks import (
+    DeliveryOutcome,
+    Webhook,
+    async_enqueue_webhook,
+    async_send_webhook,
+    dispatch_outbox,
+)
 
+ALARMS_CHUNK_SIZE = 1000
+ALARMS_PARALLEL_CHUNKS = 4
+# seconds, chunks not started by then are sent from outbox, started ones
+# take up to HOOKS_TIMEOUT more, so task ends before its timeout
+ALARMS_SEND_DEADLINE = 20
+# seconds, later alarms are useless
+ALARMS_DELIVERY_TTL = 30 * 60
+WEEKLY_REPORTS_CHUNK = 1000
+# ids range deleted in one transaction, so writers don't wait long for db lock
+DB_CLEANER_CHUNK = 5000
+# seconds, pause between cleaner and vacuum steps to let writers in
+DB_CLEANER_PAUSE = 0.1
+# free pages returned to filesystem in one vacuum step
+DB_VACUUM_PAGES = 1000
+DB_VACUUM_MAX_STEPS = 100
+
+
+def get_alarms_webhook(
+    channel: Channel, time: str, channel_ids: list[int]
+) -> Webhook:
+    return Webhook(
+        channel,
+        "alarms",
+        json={"channel_ids": channel_ids, "time": time},
+        expire_at=datetime.now(timezone.utc).timestamp() + ALARMS_DELIVERY_TTL,
+    )
 
-async def call_channel_hook(
-    url: str,
-    *,
-    json: dict | None = None,
-) -> httpx.Response:
-    async with httpx.AsyncClient(verify=str(CERTS_DIR / "ssl-cert.pem")) as client:
-        client.headers.update(
-            {
-                "Authorization": "Bearer "
-                + gen_jwt_token({"issuer": "webapp", "reason": "alarms"})
-            }
-        )
-        return await client.post(url, json=json)
+
+async def send_alarms_chunk(
+    redis: aredis.Redis,
+    webhook: Webhook,
+    channel_url: str,
+    semaphore: asyncio.Semaphore,
+) -> DeliveryOutcome:
+    """Sends chunk of alarms and releases semaphore slot acquired for it"""
+    try:
+        return await async_send_webhook(redis, webhook, settings.outbox, channel_url)
+    finally:
+        semaphore.release()
+
+
+async def acquire_chunk_slot(semaphore: asyncio.Semaphore, timeout: float) -> bool:
+    """Returns False, if no slot was freed in `timeout` seconds"""
+    if not semaphore.locked():
+        await semaphore.acquire()
+        return True
+
+    try:
+        await asyncio.wait_for(semaphore.acquire(), max(timeout, 0))
+    except TimeoutError:
+        return False
+    return True
 
 
 async def alarm_task(time: str):
-    futures = []
+    """Streams users of the alarm bucket in chunks, so big buckets don't
+    have to fit in memory or in one request. Chunks are sent in parallel,
+    but no more than ALARMS_PARALLEL_CHUNKS at once. Chunks, which can't be
+    sent until ALARMS_SEND_DEADLINE, are left to outbox, so slow channel
+    doesn't make the task run into its timeout."""
+    semaphore = asyncio.Semaphore(ALARMS_PARALLEL_CHUNKS)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ALARMS_SEND_DEADLINE
     async with redis_helper.async_connection() as redis:
         for channel in Channel:
-            channel_subs = await redis.smembers(rk.alarms_users(channel, time))
-            if not channel_subs:
+            users_key = rk.alarms_users(channel, time)
+            if not await redis.exists(users_key):
                 continue
 
             channel_url = await redis.get(rk.webhooks_url(channel))
             if not channel_url:
                 logging.warning(
-                    "No registered url for channel {channel}, but alarms was set"
+                    f"No registered url for channel {channel}, but alarms was set"
                 )
                 continue
 
-            coro = call_channel_hook(
-                concat_url(str(channel_url), "alarms"),
-                json={"channel_ids": list(channel_subs), "time": time},
-            )
-            futures.append(coro)
+            chunks: list[asyncio.Task[DeliveryOutcome]] = []
+            postponed = 0
 
-    await asyncio.gather(*futures)
+            async def start_chunk(channel_ids: list[int]):
+                nonlocal postponed
+                webhook = get_alarms_webhook(channel, time, channel_ids)
+                if not await acquire_chunk_slot(semaphore, deadline - loop.time()):
+                    # outbox schedule is scored in epoch seconds, not in loop time
+                    await async_enqueue_webhook(
+                        redis, webhook, datetime.now(timezone.utc).timestamp()
+                    )
+                    postponed += 1
+                    return
 
+                chunks.append(
+                    asyncio.create_task(
+                        send_alarms_chunk(redis, webhook, channel_url, semaphore)
+                    )
+                )
 
-async def get_channel_users(channels: list[Channel]) -> list[User]:
-    users = []
-    async with db_helper.async_session() as session:
-        stmt = select(User).where(User.channel.in_(channels))
-        result = await session.execute(stmt)
-        users = list(result.scalars().all())
-
-    return users
-
-
-async def order_report(
-    redis_client: aredis.Redis,
-    user: User,
-    requester: ReportRequester,
-    interval: Sequence[str],
-):
-    task = ReportTaskInfo(
-        user.id,
-        Channel(user.channel),
-        user.channel_id,
-        requester,
-        interval[0],
-        interval[-1],
-    )
-    await redis_client.rpush(rk.reports_queue, task.to_str())
+            channel_ids: list[int] = []
+            # set changed while scanned may return user twice, it's rare and
+            # cheaper than keeping all scanned users
+            scan = redis.sscan_iter(users_key, count=ALARMS_CHUNK_SIZE)
+            async for channel_id in scan:
+                channel_ids.append(int(channel_id))
+                if len(channel_ids) >= ALARMS_CHUNK_SIZE:
+                    await start_chunk(channel_ids)
+                    channel_ids = []
+
+            if channel_ids:
+                await start_chunk(channel_ids)
+
+            outcomes = await asyncio.gather(*chunks)
+            delayed = postponed + len(outcomes) - outcomes.count(DeliveryOutcome.sent)
+            if delayed:
+                logging.warning(
+                    f"{delayed} of {len(outcomes) + postponed} {channel} alarms "
+                    f"chunks at {time} weren't sent right away"
+                )
+
+
+@scheduler_task(pass_fire_time=True)
+async def alarm_wheel_task(fire_time: datetime | None = None):
+    """Fires every minute and reminds users whose alarm bucket is this utc minute"""
+    fire_time = fire_time or datetime.now(timezone.utc)
+    await alarm_task(fire_time.astimezone(timezone.utc).strftime(TIME_FMT))
 
 
-async def weekly_report_task():
-    coros = []
+@scheduler_task
+async def webhooks_outbox_task():
+    """Retries webhooks, which weren't sent right away"""
     async with redis_helper.async_connection() as redis:
-        today = datetime.today()
-        weekday = today.isoweekday()
-        last_week_interval = (
-            (today - timedelta(days=weekday + 6)).strftime(ENTRY_DATE_FORMAT),  # monday
-            (today - timedelta(days=weekday)).strftime(ENTRY_DATE_FORMAT),  # sunday
-        )
+        if sent := await dispatch_outbox(redis, settings.outbox):
+            logging.info(f"{sent} webhooks from outbox were sent")
+
+
+@scheduler_task
+async def alarms_rebucket_task():
+    """Keeps alarm buckets of users with named timezones up to date with
+    timezones offsets, e.g. after DST transitions"""
+    # alarm tasks are moved to dead letters after this long
+    tasks_ttl = settings.queues.max_deliveries * (
+        settings.queues.claim_idle + settings.queues.claim_interval
+    )
+    async with redis_helper.async_connection() as redis:
+        removed_before = await get_index_version(redis, tasks_ttl)
+        for channel in Channel:
+            if moved := await rebucket_alarms(redis, channel, removed_before):
+                logging.info(f"Moved {moved} {channel} users to new alarm buckets")
 
+
+@scheduler_task(pass_fire_time=True)
+async def weekly_report_task(fire_time: datetime | None = None):
+    """Orders last week reports of users, who have entries in that week.
+    Users are read from db chunk by chunk and their reports are spread over
+    rollout window."""
+    # report for the week of missed run, if run was delayed
+    today = fire_time or datetime.today()
+    weekday = today.isoweekday()
+    last_week_dates = [
+        (today - timedelta(days=weekday + 6 - i)).strftime(ENTRY_DATE_FORMAT)
+        for i in range(7)  # monday to sunday
+    ]
+
+    ordered = 0
+    async with redis_helper.async_connection() as redis:
         ch_list = list(Channel)
         ch_urls = await redis.mget([rk.webhooks_url(ch) for ch in ch_list])
         available_channels = [
             ch for ch, url in zip(ch_list, ch_urls) if url is not None
         ]
+        if not available_channels:
+            return
 
-        users = await get_channel_users(available_channels)
+        has_week_entries = (
+            select(JournalEntry.id)
+            .where(JournalEntry.user_id == User.id)
+            .where(JournalEntry.date.in_(last_week_dates))
+            .exists()
+        )
+        query = (
+            select(User.id, User.channel, User.channel_id)
+            .where(User.channel.in_(available_channels))
+            .where(has_week_entries)
+        )
+        async with db_helper.async_session() as session:
+            total = await session.scalar(
+                select(func.count()).select_from(query.subquery())
+            )
+            window = get_rollout_window(
+                total or 0,
+                settings.scheduler.reports_window,
+                settings.scheduler.reports_rate,
+            )
+            start = datetime.now(timezone.utc)
+            await start_rollout(redis, start, window, total or 0)
 
-        coros = [
-            order_report(redis, user, ReportRequester.webapp, last_week_interval)
-            for user in users
-        ]
+            result = await session.stream(
+                query.execution_options(yield_per=WEEKLY_REPORTS_CHUNK)
+            )
+            async for rows in result.partitions():
+                tasks = [
+                    (
+                        user_id,
+                        ReportTaskInfo(
+                            user_id,
+                            Channel(channel),
+                            channel_id,
+                            ReportRequester.webapp,
+                            last_week_dates[0],
+                            last_week_dates[-1],
+                        ).to_str(),
+                    )
+                    for user_id, channel, channel_id in rows
+                ]
+                await delay_reports(redis, start, window, tasks)
+                ordered += len(tasks)
 
-        await asyncio.gather(*coros)
+    logging.info(f"{ordered} weekly reports were scheduled over {window} minutes")
+
+
+@scheduler_task
+async def reports_rollout_task():
+    """Fires every minute and orders weekly reports, which slot has come"""
+    async with redis_helper.async_connection() as redis:
+        now = datetime.now(timezone.utc)
+        if released := await release_reports(
+            redis, now, settings.scheduler.reports_rate
+        ):
+            progress = await get_rollout_progress(redis)
+            logging.info(
+                f"{released} weekly reports were ordered, "
+                f"{progress.get('released', 0)} of {progress.get('total', 0)} "
+                f"in rollout, {progress['delayed']} are waiting"
+            )
 
 
+@scheduler_task
 async def db_cleaner_task():
+    """Deletes expired entries range by range of ids, every range in its
+    own short transaction"""
     today = datetime.today()
     allowed_dates = [
         (today - timedelta(days=i)).strftime(ENTRY_DATE_FORMAT)
         for i in range(DAYS_TO_STORE_ENTRIES)
     ]
+    deleted = 0
     async with db_helper.async_session() as session:
-        stmt = select(JournalEntry.id).filter(JournalEntry.date.not_in(allowed_dates))
-        entries = await session.execute(stmt)
-        entries = list(entries.scalars().all())
-        if entries:
-            del_stmt = delete(JournalEntry).where(JournalEntry.id.in_(entries))
-            await session.execute(del_stmt)
+        ids_range = select(func.min(JournalEntry.id), func.max(JournalEntry.id))
+        min_id, max_id = (await session.execute(ids_range)).one()
+        if min_id is None:
+            return
+
+        ids_total = max_id - min_id + 1
+
+        for start_id in range(min_id, max_id + 1, DB_CLEANER_CHUNK):
+            del_stmt = (
+                delete(JournalEntry)
+                .where(JournalEntry.id >= start_id)
+                .where(JournalEntry.id < start_id + DB_CLEANER_CHUNK)
+                .where(JournalEntry.date.not_in(allowed_dates))
+            )
+            result = await session.execute(del_stmt)
             await session.commit()
-        logging.info(f"Deleted {len(entries)} rows from JournalEntry")
+            if result.rowcount:
+                deleted += result.rowcount
+                checked = min(start_id + DB_CLEANER_CHUNK - min_id, ids_total)
+                logging.info(
+                    f"Deleted {deleted} rows from JournalEntry, "
+                    f"{checked * 100 // ids_total}% of ids checked"
+                )
+            await asyncio.sleep(DB_CLEANER_PAUSE)
+
+    if deleted:
+        # cached reports may show deleted entries
+        async with redis_helper.async_connection() as redis:
+            await clear_reports_cache(redis)
+    logging.info(f"Deleted {deleted} rows from JournalEntry")
+
+
+@scheduler_task
+async def db_vacuum_task():
+    """Returns free pages left by deleted rows to filesystem step by step.
+    Needs sqlite db with incremental auto vacuum, see enable_incremental_vacuum."""
+    if db_helper.async_engine.dialect.name != "sqlite":
+        return
+
+    freed = 0
+    async with db_helper.async_engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if (await conn.scalar(text("PRAGMA auto_vacuum"))) != 2:
+            logging.warning("Incremental vacuum isn't enabled for db")
+            return
+
+        for _ in range(DB_VACUUM_MAX_STEPS):
+            free_pages = await conn.scalar(text("PRAGMA freelist_count"))
+            if not free_pages:
+                break
+
+            # executed statement frees only one page, script runs to completion
+            raw_conn = await conn.get_raw_connection()
+            await raw_conn.driver_connection.executescript(
+                f"PRAGMA incremental_vacuum({DB_VACUUM_PAGES})"
+            )
+            freed += min(free_pages, DB_VACUUM_PAGES)
+            await asyncio.sleep(DB_CLEANER_PAUSE)
+
+    if freed:
+        logging.info(f"Vacuum freed {freed} db pages")
@@ -1,25 +1,48 @@
 import asyncio
 import logging
 import platform
+from collections import defaultdict
+from contextlib import suppress
 from datetime import datetime, time, timedelta
-from typing import Iterable
+from typing import AsyncGenerator
 
 from redis.asyncio import Redis
+from redis.asyncio.lock import Lock
 from sqlalchemy import select
 
-from common.constants import MSK_TIMEZONE_OFFSET, TIME_FMT, Channel
+from common.constants import MSK_TIMEZONE_OFFSET, Channel
 from webapp.core import db_helper, redis_helper
 from webapp.core.models import User
-from webapp.core.redis import AlarmActions, AlarmTaskInfo
+from webapp.core.redis import AlarmTaskInfo, StreamEntry, TaskStream
 from webapp.core.redis import RedisKeys as rk
 from webapp.core.settings import init_test_settings, settings
+from webapp.workers.scheduler.alarms import (
+    apply_alarm_tasks,
+    get_index_version,
+    remove_missing_alarms,
+    set_users_alarms,
+    sync_users_alarms,
+)
+from webapp.workers.scheduler.job_stores import RedisJobStore
+from webapp.workers.scheduler.jobs import Misfire, MisfirePolicy
 from webapp.workers.scheduler.scheduler import Scheduler
 from webapp.workers.scheduler.tasks import (
-    alarm_task,
+    alarm_wheel_task,
+    alarms_rebucket_task,
     db_cleaner_task,
+    db_vacuum_task,
+    reports_rollout_task,
+    webhooks_outbox_task,
     weekly_report_task,
 )
 from webapp.workers.utils import GracefulExit, GracefulKiller
+from webapp.workers.webhooks import close_hooks_client
+
+
+ALARMS_CHUNK = 5000
+ALARMS_TASKS_BATCH = 1000
+# seconds, init lock is extended while scheduler tasks are built
+INIT_LOCK_TIMEOUT = 60
 
 
 def nearest_weekday(day=0) -> datetime:
@@ -28,49 +51,26 @@ def nearest_weekday(day=0) -> datetime:
     return today + diff
 
 
-def create_start_date(time: str) -> datetime:
-    start_time = datetime.strptime(time, TIME_FMT).time()
-    start_date = datetime.combine(datetime.today(), start_time)
-
-    return start_date
-
-
-async def handle_alarm_task(info: AlarmTaskInfo, scheduler: Scheduler, redis: Redis):
-    args_key = rk.alarms_users(info.channel, info.alarm)
-    alarm_args = [rk.alarms_users(channel, info.alarm) for channel in Channel]
+async def handle_alarm_tasks(entries: list[StreamEntry], redis: Redis):
+    """Applies batch of alarm tasks, only the net effect of every user's tasks.
+    Stream entry ids are versions of tasks, so reclaimed tasks don't override
+    newer ones."""
+    tasks = []
+    for entry_id, task_key in entries:
+        if info := AlarmTaskInfo.from_str(task_key):
+            tasks.append((entry_id, info))
+        else:
+            logging.error(f"Can't parse task info: {task_key}")
 
-    if info.action == AlarmActions.add:
-        # create new job it there was none planned for specific time
-        if not await redis.exists(*alarm_args):
-            job = await scheduler.add_job(
-                alarm_task,
-                [info.alarm],
-                start_date=create_start_date(info.alarm),
-                interval=timedelta(days=1),
-            )
-            await redis.hset(rk.alarms_job, info.alarm, job.id)
-
-        await redis.sadd(args_key, info.channel_id)
-
-    elif info.action == AlarmActions.delete:
-        await redis.srem(args_key, info.channel_id)
-        # delete job if no args left for alarm
-        if not await redis.exists(*alarm_args):
-            job_id = await redis.hget(rk.alarms_job, info.alarm)
-            if not job_id:
-                logging.error(f"Job_id for {args_key} wasn't found. Task info: {info}")
-                return
-
-            await scheduler.remove_job(job_id)
-            await redis.hdel(rk.alarms_job, info.alarm)
+    await apply_alarm_tasks(redis, tasks)
 
 
 async def clean_redis_keys():
+    """Drops alarm index before full rebuild. Pending alarm tasks are kept,
+    they're handled after rebuild and lead to the same state as in db."""
     keys_to_del = [
-        rk.scheduler_jobs,
-        rk.scheduler_runtimes,
-        rk.alarms_queue,
         rk.alarms_job,
+        *[rk.alarms_index(channel) for channel in Channel],
     ]
     alarms_keys = []
     async with redis_helper.async_connection() as redis:
@@ -78,60 +78,199 @@ async def clean_redis_keys():
         await redis.unlink(*keys_to_del, *alarms_keys)
 
 
-async def initialize_scheduler_tasks(scheduler: Scheduler):
-    await clean_redis_keys()
+async def keep_init_lock(lock: Lock, scheduler: Scheduler):
+    """Extends init lock and heartbeat of not yet started scheduler, so
+    long alarms rebuild isn't taken for dead scheduler by other ones"""
+    while True:
+        await asyncio.sleep(INIT_LOCK_TIMEOUT / 3)
+        await lock.reacquire()
+        await scheduler.heartbeat()
 
-    nearest_monday = nearest_weekday(0)
+
+async def initialize_scheduler_tasks(
+    scheduler: Scheduler, rebuild_alarms: bool = False
+):
     scheduler.set_timezone(MSK_TIMEZONE_OFFSET)
+    async with redis_helper.async_connection() as redis:
+        # schedulers share jobs, so only the first started one builds them
+        lock = redis.lock(rk.scheduler_init_lock, timeout=INIT_LOCK_TIMEOUT)
+        async with lock:
+            if instances := await scheduler.get_live_instances():
+                if rebuild_alarms:
+                    raise RuntimeError(
+                        f"Alarms can't be rebuilt while schedulers run: {instances}"
+                    )
+                logging.info(f"Joining running schedulers: {instances}")
+                await scheduler.heartbeat()
+                return
+
+            await scheduler.heartbeat()
+            keeper = asyncio.create_task(keep_init_lock(lock, scheduler))
+            try:
+                await build_scheduler_tasks(scheduler, rebuild_alarms)
+            finally:
+                keeper.cancel()
+                with suppress(asyncio.CancelledError):
+                    await keeper
+
+
+async def build_scheduler_tasks(scheduler: Scheduler, rebuild_alarms: bool = False):
+    async with redis_helper.async_connection() as redis:
+        await redis.unlink(rk.alarms_job)
+        # buckets made before alarm index are keyed by moscow time and can't
+        # be reconciled, they're only dropped by full rebuild
+        has_index = await redis.exists(*[rk.alarms_index(ch) for ch in Channel])
+
+    nearest_monday = nearest_weekday(0)
     await scheduler.add_job(
         weekly_report_task,
         start_date=datetime.combine(nearest_monday, time(hour=23)),
         interval=timedelta(days=7),
+        job_id=weekly_report_task.__name__,
+        misfire=Misfire(MisfirePolicy.coalesce),
+        replace_existing=False,
+    )
+    await scheduler.add_job(
+        alarm_wheel_task,
+        start_date=datetime.combine(datetime.today(), time()),
+        interval=timedelta(minutes=1),
+        job_id=alarm_wheel_task.__name__,
+        # each missed minute has its own users to remind
+        misfire=Misfire(MisfirePolicy.run_all, max_runs=15),
+        replace_existing=False,
+    )
+    await scheduler.add_job(
+        reports_rollout_task,
+        start_date=datetime.combine(datetime.today(), time()),
+        interval=timedelta(minutes=1),
+        job_id=reports_rollout_task.__name__,
+        # delayed reports of all missed minutes are ordered at once
+        misfire=Misfire(MisfirePolicy.coalesce),
+        replace_existing=False,
+    )
+    await scheduler.add_job(
+        alarms_rebucket_task,
+        interval=timedelta(hours=1),
+        job_id=alarms_rebucket_task.__name__,
+        misfire=Misfire(MisfirePolicy.coalesce),
+        replace_existing=False,
+    )
+    await scheduler.add_job(
+        webhooks_outbox_task,
+        interval=timedelta(seconds=10),
+        job_id=webhooks_outbox_task.__name__,
+        misfire=Misfire(MisfirePolicy.coalesce),
+        replace_existing=False,
     )
     await scheduler.add_job(
         db_cleaner_task,
         start_date=datetime.combine(datetime.today(), time(hour=22)),
         interval=timedelta(days=1),
+        job_id=db_cleaner_task.__name__,
+        misfire=Misfire(MisfirePolicy.coalesce),
+        replace_existing=False,
+    )
+    await scheduler.add_job(
+        db_vacuum_task,
+        start_date=datetime.combine(datetime.today(), time(minute=30)),
+        interval=timedelta(hours=1),
+        job_id=db_vacuum_task.__name__,
+        misfire=Misfire(MisfirePolicy.coalesce),
+        replace_existing=False,
     )
 
-    users: Iterable[User] = []
+    if rebuild_alarms or not has_index:
+        logging.info("Rebuilding alarm index")
+        await clean_redis_keys()
+        await rebuild_users_alarms()
+    else:
+        await reconcile_users_alarms()
+
+
+async def stream_users_alarms() -> (
+    AsyncGenerator[list[tuple[Channel, int, str, str | None]], None]
+):
+    """Yields chunks of (channel, channel_id, alarm, timezone) of users with alarms"""
+    query = (
+        select(User.channel, User.channel_id, User.alarm, User.timezone)
+        .where(User.alarm.is_not(None))
+        .execution_options(yield_per=ALARMS_CHUNK)
+    )
     async with db_helper.async_session() as session:
-        users = await session.scalars(select(User).where(User.alarm.is_not(None)))
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            yield [
+                (Channel(channel), channel_id, str(alarm), timezone)
+                for channel, channel_id, alarm, timezone in rows
+            ]
+
 
+async def rebuild_users_alarms():
+    """Fills empty alarm index from db chunk by chunk"""
     async with redis_helper.async_connection() as redis:
-        for user in users:
-            await handle_alarm_task(
-                AlarmTaskInfo(
-                    AlarmActions.add, Channel(user.channel), user.channel_id, str(user.alarm)
-                ),
-                scheduler,
-                redis,
+        version = await get_index_version(redis)
+        async for alarms in stream_users_alarms():
+            await set_users_alarms(redis, alarms, version)
+
+
+async def reconcile_users_alarms():
+    """Applies differences between users alarms in db and alarm index.
+    Pending alarm tasks are kept, they're handled after reconciliation."""
+    channels_ids: dict[Channel, set[int]] = defaultdict(set)
+    moved = removed = 0
+    async with redis_helper.async_connection() as redis:
+        # db state is newer than tasks added before sync
+        version = await get_index_version(redis)
+        async for alarms in stream_users_alarms():
+            for channel, channel_id, *_ in alarms:
+                channels_ids[channel].add(channel_id)
+            moved += await sync_users_alarms(redis, alarms, version)
+
+        for channel in Channel:
+            removed += await remove_missing_alarms(
+                redis, channel, channels_ids[channel], version
             )
 
+    logging.info(f"Alarms reconciled: {moved} users moved, {removed} users removed")
+
 
-async def main():
-    scheduler = Scheduler(settings.redis)
-    await initialize_scheduler_tasks(scheduler)
+async def main(rebuild_alarms: bool = False):
+    scheduler = Scheduler(RedisJobStore(settings.redis), settings.scheduler)
+    await initialize_scheduler_tasks(scheduler, rebuild_alarms)
     await scheduler.start()
 
     gk = GracefulKiller(raise_ex=True)
-    async with redis_helper.async_connection() as redis:
-        while not gk.exit_now:
-            task_key = await redis.blpop(rk.alarms_queue, 1)
-            if not task_key:
-                continue
-
-            info = AlarmTaskInfo.from_str(task_key[1])
-            if not info:
-                logging.error(f"Can't parse task info: {task_key[1]}")
-                continue
-
-            await handle_alarm_task(info, scheduler, redis)
+    try:
+        async with redis_helper.async_connection() as redis:
+            stream = TaskStream(
+                redis,
+                rk.alarms_queue,
+                rk.alarms_dead_letters,
+                rk.alarms_group,
+                settings.queues,
+            )
+            await stream.start(rk.alarms_legacy_queue)
+            while not gk.exit_now:
+                # tasks piled up meanwhile, e.g. during broadcast, are read at once
+                entries = await stream.read(ALARMS_TASKS_BATCH, block=1)
+                if not entries:
+                    continue
 
-    await scheduler.shutdown()
+                try:
+                    await handle_alarm_tasks(entries, redis)
+                except Exception as ex:
+                    # not acked tasks are reclaimed and retried later
+                    logging.error(f"Alarm tasks failed: {ex!r}")
+                    continue
+                await stream.ack([entry_id for entry_id, _ in entries])
+    finally:
+        # termination signal is raised as GracefulExit, instance must be
+        # removed anyway, so the next start isn't taken for joining
+        await scheduler.shutdown()
+        await close_hooks_client()
 
 
-def worker(test_config: bool = False):
+def worker(test_config: bool = False, rebuild_alarms: bool = False):
     if test_config:
         init_test_settings()
 
@@ -142,7 +281,7 @@ def worker(test_config: bool = False):
 
     loop = asyncio.new_event_loop()
     try:
-        loop.run_until_complete(main())
+        loop.run_until_complete(main(rebuild_alarms))
     except GracefulExit:
         logging.info("Worker got termination signal. Shutting down...")
 
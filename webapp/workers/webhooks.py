@@ -0,0 +1,432 @@
+"""Webhooks from webapp to channels.
+
+Webhook is sent right away. If channel is down, it's put to redis outbox and
+retried by dispatcher with exponential backoff. Webhooks, which were rejected
+or failed too many times, are moved to dead letters list.
+Every channel has circuit breaker: after several failures in a row channel
+isn't called for a while, its webhooks wait in outbox instead.
+"""
+
+import asyncio
+import base64
+import importlib.util
+import json
+import logging
+import random
+import time
+from enum import StrEnum, auto
+from typing import Any, Self
+from uuid import uuid4
+
+import httpx
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+from common.constants import CERTS_DIR, Channel
+from common.utils import concat_url, get_cached_jwt_token
+from webapp.core.redis import RedisKeys as rk
+from webapp.core.settings import OutboxSettings
+
+# http2 extra of httpx, connections to channel are multiplexed if it's installed
+HOOKS_HTTP2 = importlib.util.find_spec("h2") is not None
+HOOKS_TIMEOUT = httpx.Timeout(30, connect=5)
+HOOKS_LIMITS = httpx.Limits(
+    max_connections=100, max_keepalive_connections=20, keepalive_expiry=60
+)
+# statuses of temporary failures, webhook is retried
+RETRY_STATUSES = {408, 425, 429}
+# seconds, circuit of channel without failures is forgotten
+CIRCUIT_TTL = 24 * 60 * 60
+
+# Claims due webhooks for lease time, so other dispatchers don't send them
+# meanwhile. Webhook, which dispatcher failed to handle, is retried after lease.
+# KEYS: schedule zset, outbox hash; ARGV: current timestamp, limit, lease seconds
+# Returns flat list of claimed ids and encoded webhooks.
+CLAIM_WEBHOOKS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[2])
+local claimed = {}
+for _, message_id in ipairs(ids) do
+    local message = redis.call('HGET', KEYS[2], message_id)
+    if message then
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), message_id)
+        table.insert(claimed, message_id)
+        table.insert(claimed, message)
+    else
+        redis.call('ZREM', KEYS[1], message_id)
+    end
+end
+return claimed
+"""
+
+_hooks_client: httpx.AsyncClient | None = None
+
+
+def get_hooks_client() -> httpx.AsyncClient:
+    """Process wide client, so channel hooks calls reuse connections"""
+    global _hooks_client
+    if _hooks_client is None or _hooks_client.is_closed:
+        _hooks_client = httpx.AsyncClient(
+            verify=str(CERTS_DIR / "ssl-cert.pem"),
+            http2=HOOKS_HTTP2,
+            timeout=HOOKS_TIMEOUT,
+            limits=HOOKS_LIMITS,
+        )
+    return _hooks_client
+
+
+async def close_hooks_client():
+    global _hooks_client
+    if _hooks_client is not None:
+        await _hooks_client.aclose()
+        _hooks_client = None
+
+
+def get_auth_headers() -> dict[str, str]:
+    token = get_cached_jwt_token({"issuer": "webapp", "reason": "alarms"})
+    return {"Authorization": "Bearer " + token}
+
+
+class DeliveryOutcome(StrEnum):
+    sent = auto()
+    retry = auto()  # temporary failure, e.g. channel is down
+    failed = auto()  # webhook won't be accepted, e.g. it was rejected by channel
+    postponed = auto()  # circuit of channel is open, webhook waits until it's closed
+
+
+class Webhook:
+    """Request to `endpoint` of channel webhooks url, which can be stored in outbox"""
+
+    def __init__(
+        self,
+        channel: Channel,
+        endpoint: str,
+        *,
+        json: dict[str, Any] | None = None,
+        data: dict[str, Any] | None = None,
+        file: tuple[str, bytes, str] | None = None,
+        expire_at: float | None = None,
+        attempts: int = 0,
+        error: str | None = None,
+        message_id: str | None = None,
+    ) -> None:
+        self.id = message_id or str(uuid4())
+        self.channel = channel
+        self.endpoint = endpoint
+        self.json = json
+        self.data = data
+        self.file = file  # filename, content, content type
+        # timestamp, webhook isn't sent after it, e.g. too late alarm is useless
+        self.expire_at = expire_at
+        self.attempts = attempts
+        self.error = error
+
+    def __repr__(self) -> str:
+        return f"Webhook({self.channel}/{self.endpoint}, id={self.id})"
+
+    def to_json(self) -> str:
+        file = None
+        if self.file:
+            filename, content, content_type = self.file
+            file = [filename, base64.b64encode(content).decode(), content_type]
+
+        return json.dumps(
+            {
+                "id": self.id,
+                "channel": self.channel,
+                "endpoint": self.endpoint,
+                "json": self.json,
+                "data": self.data,
+                "file": file,
+                "expire_at": self.expire_at,
+                "attempts": self.attempts,
+                "error": self.error,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> Self:
+        decoded = json.loads(data)
+        file = decoded["file"]
+        if file:
+            file = (file[0], base64.b64decode(file[1]), file[2])
+
+        return cls(
+            Channel(decoded["channel"]),
+            decoded["endpoint"],
+            json=decoded["json"],
+            data=decoded["data"],
+            file=file,
+            expire_at=decoded["expire_at"],
+            attempts=decoded["attempts"],
+            error=decoded["error"],
+            message_id=decoded["id"],
+        )
+
+    def is_expired(self, timestamp: float) -> bool:
+        return self.expire_at is not None and self.expire_at <= timestamp
+
+    def get_url(self, channel_url: str) -> str:
+        return concat_url(channel_url, self.endpoint)
+
+    def get_request_kwargs(self) -> dict[str, Any]:
+        kwargs: dict[str, Any] = {"headers": get_auth_headers()}
+        if self.json is not None:
+            kwargs["json"] = self.json
+        if self.data is not None:
+            kwargs["data"] = self.data
+        if self.file:
+            kwargs["files"] = {"file": self.file}
+        return kwargs
+
+
+def get_outcome(
+    response: httpx.Response | None, error: Exception | None = None
+) -> tuple[DeliveryOutcome, str]:
+    """Returns outcome of webhook request and error description"""
+    if response is None:
+        return DeliveryOutcome.retry, repr(error)
+
+    if response.is_success:
+        return DeliveryOutcome.sent, ""
+
+    reason = f"{response.status_code} {response.reason_phrase}"
+    if response.is_server_error or response.status_code in RETRY_STATUSES:
+        return DeliveryOutcome.retry, reason
+    return DeliveryOutcome.failed, reason
+
+
+def get_unsent_outcome(
+    webhook: Webhook, open_until: float, channel_url: str | None, now: float
+) -> tuple[DeliveryOutcome, str] | None:
+    """Returns outcome and error of webhook, which isn't sent to channel:
+    expired one or one, which open circuit of channel doesn't let through.
+    Returns None, if webhook should be sent."""
+    if webhook.is_expired(now):
+        return DeliveryOutcome.failed, "Expired"
+
+    if open_until > now:
+        if webhook.is_expired(open_until):
+            # dead channel isn't called for webhook, which can't wait for it
+            return DeliveryOutcome.failed, "Expires while circuit is open"
+        return DeliveryOutcome.postponed, "Circuit is open"
+
+    if not channel_url:
+        return DeliveryOutcome.retry, "No registered url for channel"
+    return None
+
+
+def log_outcome(webhook: Webhook, outcome: DeliveryOutcome, error: str):
+    if outcome in (DeliveryOutcome.retry, DeliveryOutcome.failed):
+        logging.warning(f"{webhook!r} attempt #{webhook.attempts} failed: {error}")
+
+
+def get_retry_delay(attempts: int, outbox_settings: OutboxSettings) -> float:
+    """Exponential backoff with jitter, so webhooks failed at once aren't
+    retried at once"""
+    delay = min(
+        outbox_settings.backoff_cap,
+        outbox_settings.backoff_base * 2 ** max(attempts - 1, 0),
+    )
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _add_enqueue_commands(pipe, webhook: Webhook, timestamp: float):
+    pipe.hset(rk.webhooks_outbox, webhook.id, webhook.to_json())
+    pipe.zadd(rk.webhooks_schedule, {webhook.id: timestamp})
+
+
+def _add_outcome_commands(
+    pipe,
+    webhook: Webhook,
+    outcome: DeliveryOutcome,
+    error: str,
+    outbox_settings: OutboxSettings,
+    open_until: float,
+):
+    """Adds commands, which save outcome of webhook attempt. If outcome is
+    retry, the first command result is number of channel failures in a row."""
+    if outcome == DeliveryOutcome.postponed:
+        _add_enqueue_commands(pipe, webhook, open_until)
+        return
+
+    circuit_key = rk.webhooks_circuit(webhook.channel)
+    if outcome == DeliveryOutcome.sent:
+        pipe.delete(circuit_key)
+        pipe.hdel(rk.webhooks_outbox, webhook.id)
+        pipe.zrem(rk.webhooks_schedule, webhook.id)
+        return
+
+    if outcome == DeliveryOutcome.retry:
+        pipe.hincrby(circuit_key, "failures", 1)
+        pipe.expire(circuit_key, CIRCUIT_TTL)
+
+    webhook.error = error
+    now = time.time()
+    if (
+        outcome == DeliveryOutcome.failed
+        or webhook.attempts >= outbox_settings.max_attempts
+        or webhook.is_expired(now)
+    ):
+        logging.error(f"{webhook!r} is undelivered after {webhook.attempts} attempts")
+        pipe.rpush(rk.webhooks_dead_letters, webhook.to_json())
+        pipe.ltrim(rk.webhooks_dead_letters, -outbox_settings.dead_letters_limit, -1)
+        pipe.hdel(rk.webhooks_outbox, webhook.id)
+        pipe.zrem(rk.webhooks_schedule, webhook.id)
+        return
+
+    retry_at = now + get_retry_delay(webhook.attempts, outbox_settings)
+    _add_enqueue_commands(pipe, webhook, retry_at)
+
+
+def _get_open_until(failures: int, outbox_settings: OutboxSettings) -> float | None:
+    """Returns time until which circuit is open, if too many failures happened.
+    Failures counter is reset by success only, so after cooldown circuit is
+    opened again by the first failure."""
+    if failures < outbox_settings.circuit_threshold:
+        return None
+    return time.time() + outbox_settings.circuit_cooldown
+
+
+def enqueue_webhook(redis: Redis, webhook: Webhook, timestamp: float):
+    with redis.pipeline() as pipe:
+        _add_enqueue_commands(pipe, webhook, timestamp)
+        pipe.execute()
+
+
+def get_circuit_open_until(redis: Redis, channel: Channel) -> float:
+    open_until = redis.hget(rk.webhooks_circuit(channel), "open_until")
+    return float(open_until) if open_until else 0
+
+
+def save_outcome(
+    redis: Redis,
+    webhook: Webhook,
+    outcome: DeliveryOutcome,
+    error: str,
+    outbox_settings: OutboxSettings,
+    open_until: float = 0,
+):
+    with redis.pipeline() as pipe:
+        _add_outcome_commands(
+            pipe, webhook, outcome, error, outbox_settings, open_until
+        )
+        results = pipe.execute()
+
+    if outcome == DeliveryOutcome.retry:
+        if opened_until := _get_open_until(results[0], outbox_settings):
+            redis.hset(
+                rk.webhooks_circuit(webhook.channel), "open_until", opened_until
+            )
+
+
+def send_webhook(
+    redis: Redis,
+    client: httpx.Client,
+    webhook: Webhook,
+    outbox_settings: OutboxSettings,
+    channel_url: str,
+) -> DeliveryOutcome:
+    """Sends webhook, it's retried from outbox if channel is unavailable"""
+    open_until = get_circuit_open_until(redis, webhook.channel)
+    if unsent := get_unsent_outcome(webhook, open_until, channel_url, time.time()):
+        outcome, error = unsent
+    else:
+        webhook.attempts += 1
+        try:
+            response = client.post(
+                webhook.get_url(channel_url), **webhook.get_request_kwargs()
+            )
+            outcome, error = get_outcome(response)
+        except httpx.TransportError as ex:
+            outcome, error = get_outcome(None, ex)
+
+    log_outcome(webhook, outcome, error)
+    save_outcome(redis, webhook, outcome, error, outbox_settings, open_until)
+    return outcome
+
+
+async def async_enqueue_webhook(redis: AsyncRedis, webhook: Webhook, timestamp: float):
+    async with redis.pipeline() as pipe:
+        _add_enqueue_commands(pipe, webhook, timestamp)
+        await pipe.execute()
+
+
+async def async_get_circuit_open_until(redis: AsyncRedis, channel: Channel) -> float:
+    open_until = await redis.hget(rk.webhooks_circuit(channel), "open_until")
+    return float(open_until) if open_until else 0
+
+
+async def async_save_outcome(
+    redis: AsyncRedis,
+    webhook: Webhook,
+    outcome: DeliveryOutcome,
+    error: str,
+    outbox_settings: OutboxSettings,
+    open_until: float = 0,
+):
+    async with redis.pipeline() as pipe:
+        _add_outcome_commands(
+            pipe, webhook, outcome, error, outbox_settings, open_until
+        )
+        results = await pipe.execute()
+
+    if outcome == DeliveryOutcome.retry:
+        if opened_until := _get_open_until(results[0], outbox_settings):
+            await redis.hset(
+                rk.webhooks_circuit(webhook.channel), "open_until", opened_until
+            )
+
+
+async def async_send_webhook(
+    redis: AsyncRedis,
+    webhook: Webhook,
+    outbox_settings: OutboxSettings,
+    channel_url: str | None = None,
+) -> DeliveryOutcome:
+    """Sends webhook, it's retried from outbox if channel is unavailable"""
+    open_until = await async_get_circuit_open_until(redis, webhook.channel)
+    channel_url = channel_url or await redis.get(rk.webhooks_url(webhook.channel))
+    if unsent := get_unsent_outcome(webhook, open_until, channel_url, time.time()):
+        outcome, error = unsent
+    else:
+        webhook.attempts += 1
+        try:
+            response = await get_hooks_client().post(
+                webhook.get_url(str(channel_url)), **webhook.get_request_kwargs()
+            )
+            outcome, error = get_outcome(response)
+        except httpx.TransportError as ex:
+            outcome, error = get_outcome(None, ex)
+
+    log_outcome(webhook, outcome, error)
+    await async_save_outcome(
+        redis, webhook, outcome, error, outbox_settings, open_until
+    )
+    return outcome
+
+
+async def dispatch_outbox(redis: AsyncRedis, outbox_settings: OutboxSettings) -> int:
+    """Sends due webhooks from outbox. Returns number of sent webhooks"""
+    claim_webhooks = redis.register_script(CLAIM_WEBHOOKS_SCRIPT)
+    claimed = await claim_webhooks(
+        keys=[rk.webhooks_schedule, rk.webhooks_outbox],
+        args=[time.time(), outbox_settings.dispatch_batch, outbox_settings.lease],
+    )
+    semaphore = asyncio.Semaphore(outbox_settings.dispatch_parallel)
+
+    async def send(message_id: str | bytes, data: str | bytes) -> DeliveryOutcome:
+        try:
+            webhook = Webhook.from_json(data)
+        except (ValueError, KeyError, TypeError) as ex:
+            logging.error(f"Can't decode webhook {message_id!r}: {ex}")
+            await redis.hdel(rk.webhooks_outbox, message_id)
+            await redis.zrem(rk.webhooks_schedule, message_id)
+            return DeliveryOutcome.failed
+
+        async with semaphore:
+            return await async_send_webhook(redis, webhook, outbox_settings)
+
+    messages = zip(claimed[::2], claimed[1::2])
+    outcomes = await asyncio.gather(*[send(*message) for message in messages])
+    return outcomes.count(DeliveryOutcome.sent)